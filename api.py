@@ -2,29 +2,42 @@
 # region "Imports"
 
 # import all needed libraries
+import asyncio
+import codecs
 import json
 import os
 import shutil
+import threading
+import time
 from datetime import datetime
 from http.client import HTTPException
-import re
 
 # fastapi libraries
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse, HTMLResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse, HTMLResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 
 from pydantic import BaseModel
+from typing import Literal
 
 # google libraries
-from gtts import gTTS
 import speech_recognition as sr
 
 # local libraries
 from infrags_mgr.memory_store import MemoryStore
 from infrags_mgr.infrag_store import InfragStore
+from infrags_mgr.ann_index import AnnConfig
 from infrags_mgr.openai_chatbot import OpenAIChatbot
 from infrags_mgr.google_chatbot import GoogleChatbot
+from infrags_mgr.embedder import get_embedder
+from infrags_mgr.response_cache import CachedChatbot, ResponseCache
+from infrags_mgr.semantic_cache import SemanticCache
+from infrags_mgr.keyword_index import tokenize
+from infrags_mgr.executors import AsyncLimiter, BoundedExecutor, CapacityExceeded
+from infrags_mgr.tts_cache import TTSCache
+from infrags_mgr.bulk_import import BulkParser, validate_item
+from infrags_mgr.tiered_storage import LocalBucket, StorageConflict
+from infrags_mgr.speech_to_text import AudioRetention, AudioTooLarge, SpeechToText, get_recognizer
 
 # endregion
 
@@ -32,6 +45,28 @@ from infrags_mgr.google_chatbot import GoogleChatbot
 
 fast_api_app = FastAPI()
 
+@fast_api_app.on_event("shutdown")
+def flush_on_shutdown():
+    # writes still waiting for the debounce delay go to the bucket now
+    infrag_store.flush()
+
+@fast_api_app.exception_handler(CapacityExceeded)
+async def capacity_exceeded_handler(request, exc):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Serveur occupé ({exc.name}), réessayez plus tard"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# the bucket was changed by another writer: writes are refused until a
+# restart pulls its files, /metrics lists the files in conflict
+@fast_api_app.exception_handler(StorageConflict)
+async def storage_conflict_handler(request, exc):
+    return JSONResponse(
+        status_code=409,
+        content={"detail": f"Écritures refusées, fichiers modifiés par une autre instance ({', '.join(exc.names)}), redémarrez le service"},
+    )
+
 static_dir = "static"
 if os.path.exists(static_dir):
     fast_api_app.mount("/static", StaticFiles(directory=static_dir), name="static")
@@ -78,6 +113,9 @@ class AskQuery(BaseModel):
     user_context: str
     instructions: str
     question: str
+    language: str = "fr-FR"
+    # None: INFRAGS_SEARCH_MODE
+    search_mode: Literal["vector", "keyword", "hybrid"] = None
 
 class LLMQuery(BaseModel):
     user_id: str
@@ -91,15 +129,138 @@ class LLMProvidingInfragsQuery(BaseModel):
     instructions: str = ""
     request: str
     language: str = "fr-FR"
+    search_mode: Literal["vector", "keyword", "hybrid"] = None
 
 # endregion
 
 # region "Instantiations"
 
-store = MemoryStore()
-infrag_store = InfragStore()
-# chatbot = OpenAIChatbot()
-chatbot = GoogleChatbot()
+# the v1 store is only built when a v1 endpoint is called
+store = None
+store_lock = threading.Lock()
+# with several uvicorn workers (UVICORN_WORKERS, see docker/Dockerfile_Final)
+# the workers share the sqlite storage, apply each other's writes from
+# its change feed and map the same vectors file; on Cloud Run the sqlite
+# database (INFRAGS_BACKEND=sqlite or several workers) must survive a
+# restart: set INFRAGS_GCS_BUCKET, or INFRAGS_SQLITE_PATH on a mounted
+# volume with INFRAGS_SQLITE_DURABLE=1
+uvicorn_workers = int(os.getenv("UVICORN_WORKERS", "1"))
+# INFRAGS_GCS_BUCKET keeps the files on local disk (INFRAGS_LOCAL_DIR) and
+# writes them back to the bucket in the background instead of going
+# through the /gcs FUSE mount, INFRAGS_FAKE_BUCKET_DIR does the same with
+# a local directory standing in for the bucket
+fake_bucket_dir = os.getenv("INFRAGS_FAKE_BUCKET_DIR")
+# partitions past INFRAGS_INDEX_PROMOTE_AT fragments get an approximate
+# index (INFRAGS_INDEX=hnsw or ivf), INFRAGS_INDEX_OVERRIDES is a JSON
+# list of {"user_id", "user_context", <AnnConfig fields>} for single
+# partitions; INFRAGS_QUANTIZER=fp16 or int8 stores the vectors of
+# partitions past INFRAGS_QUANTIZE_AT fragments quantized and re-ranks
+# INFRAGS_RERANK * k candidates with the float32 vectors read from disk;
+# python -m infrags_mgr.ann_report helps choose the settings
+index_config = AnnConfig(
+    kind=os.getenv("INFRAGS_INDEX", "flat"),
+    promote_at=int(os.getenv("INFRAGS_INDEX_PROMOTE_AT", "10000")),
+    hnsw_m=int(os.getenv("INFRAGS_HNSW_M", "32")),
+    ef_search=int(os.getenv("INFRAGS_HNSW_EF_SEARCH", "64")),
+    nprobe=int(os.getenv("INFRAGS_IVF_NPROBE", "8")),
+    quantizer=os.getenv("INFRAGS_QUANTIZER") or None,
+    quantize_at=int(os.getenv("INFRAGS_QUANTIZE_AT", "256")),
+    rerank=int(os.getenv("INFRAGS_RERANK", "4")),
+)
+index_configs = {
+    (override["user_id"], override["user_context"]): AnnConfig.from_dict({**index_config.to_dict(), **override})
+    for override in json.loads(os.getenv("INFRAGS_INDEX_OVERRIDES", "[]"))
+}
+# fragments are found by embedding (vector), BM25 (keyword) or both fused
+# (hybrid); hybrid serves queries of at most INFRAGS_KEYWORD_ONLY_TERMS
+# words found in the tenant's fragments without embedding them
+infrag_store = InfragStore(
+    backend=os.getenv("INFRAGS_BACKEND", "sqlite" if uvicorn_workers > 1 else "log"),
+    sqlite_path=os.getenv("INFRAGS_SQLITE_PATH", "infrags_mgr/data/infrags.db"),
+    shared=uvicorn_workers > 1,
+    sqlite_durable=os.getenv("INFRAGS_SQLITE_DURABLE") == "1",
+    gcs_bucket_name=os.getenv("INFRAGS_GCS_BUCKET"),
+    bucket=LocalBucket(fake_bucket_dir) if fake_bucket_dir else None,
+    local_dir=os.getenv("INFRAGS_LOCAL_DIR", "/tmp/infrags_local"),
+    flush_debounce=float(os.getenv("INFRAGS_FLUSH_DEBOUNCE", "2")),
+    index_config=index_config,
+    index_configs=index_configs,
+    search_mode=os.getenv("INFRAGS_SEARCH_MODE", "hybrid"),
+    keyword_only_terms=int(os.getenv("INFRAGS_KEYWORD_ONLY_TERMS", "2")),
+    search_k=int(os.getenv("INFRAGS_SEARCH_K", "10")),
+)
+# queries need the shared embedding model even when the index came from disk
+get_embedder().warm_up()
+# concurrent queries are embedded together, waiting at most a few ms for each other
+embedding_batch_wait_ms = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+if embedding_batch_wait_ms > 0:
+    get_embedder().enable_scheduler(
+        max_wait=embedding_batch_wait_ms / 1000,
+        max_batch=int(os.getenv("EMBEDDING_MAX_BATCH", "32")),
+    )
+# LLM_PROVIDER=openai (with OPENAI_BASE_URL) allows tests against a local fake server
+llm_timeout = int(os.getenv("LLM_TIMEOUT", "60"))
+if os.getenv("LLM_PROVIDER", "google") == "openai":
+    chatbot = OpenAIChatbot(timeout=llm_timeout)
+else:
+    chatbot = GoogleChatbot(timeout=llm_timeout)
+# identical prompts are answered from memory, entries built on a fragment
+# are dropped when that fragment is updated or deleted
+chatbot = CachedChatbot(chatbot, ResponseCache(
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    ttl=int(os.getenv("LLM_CACHE_TTL", "600")),
+))
+infrag_store.add_listener(chatbot.cache.on_infrag_changed)
+# near-duplicate questions of a tenant reuse a previous answer
+semantic_cache = SemanticCache(
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+    max_entries_per_tenant=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "256")),
+    ttl=int(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+)
+# model inference and store writes run on their own bounded pool
+# (its threads mostly wait for the batching scheduler),
+# LLM calls are async and limited in number, so a slow LLM cannot
+# starve the cheap endpoints
+embedding_executor = BoundedExecutor(
+    "embedding",
+    max_workers=int(os.getenv("EMBEDDING_WORKERS", "8")),
+    max_queue=int(os.getenv("EMBEDDING_QUEUE", "32")),
+)
+llm_limiter = AsyncLimiter("llm", max_concurrent=int(os.getenv("LLM_MAX_CONCURRENCY", "16")))
+# synthesized speech is kept by (text, language, voice_type) within a
+# disk and a memory budget, gTTS calls run on their own pool
+tts_cache = TTSCache(
+    directory=os.getenv("TTS_CACHE_DIR", "uploaded_files/tts_cache"),
+    max_disk_bytes=int(os.getenv("TTS_CACHE_MAX_DISK_BYTES", str(256 * 1024 * 1024))),
+    max_memory_bytes=int(os.getenv("TTS_CACHE_MAX_MEMORY_BYTES", str(32 * 1024 * 1024))),
+)
+tts_executor = BoundedExecutor(
+    "tts",
+    max_workers=int(os.getenv("TTS_WORKERS", "4")),
+    max_queue=int(os.getenv("TTS_QUEUE", "32")),
+)
+# uploaded audio is decoded from the upload stream and only written to
+# disk when STT_RETENTION is "errors" or "all" (for debugging),
+# STT_BACKEND=fake replaces Google for benchmarks
+speech_to_text = SpeechToText(
+    get_recognizer(os.getenv("STT_BACKEND", "google")),
+    max_bytes=int(os.getenv("STT_MAX_BYTES", str(25 * 1024 * 1024))),
+    retention=AudioRetention(
+        directory=os.getenv("STT_RETENTION_DIR", "uploaded_files/stt"),
+        mode=os.getenv("STT_RETENTION", "off"),
+        max_files=int(os.getenv("STT_RETENTION_MAX_FILES", "100")),
+    ),
+    # long recordings are cut in overlapping segments recognized in parallel
+    segment_seconds=float(os.getenv("STT_SEGMENT_SECONDS", "30")),
+    overlap_seconds=float(os.getenv("STT_OVERLAP_SECONDS", "1")),
+    workers=int(os.getenv("STT_SEGMENT_WORKERS", "4")),
+)
+stt_executor = BoundedExecutor(
+    "stt",
+    max_workers=int(os.getenv("STT_WORKERS", "4")),
+    max_queue=int(os.getenv("STT_QUEUE", "16")),
+)
 
 # endregion
 
@@ -115,6 +276,13 @@ def get_version():
         version = f"Error reading version.txt: {e}"
     return version
 
+def get_memory_store():
+    global store
+    with store_lock:
+        if store is None:
+            store = MemoryStore()
+    return store
+
 def get_is_local():
     islocal_path = "islocal.txt"
     if os.path.exists(islocal_path) and os.path.isfile(islocal_path):
@@ -134,6 +302,48 @@ def get_gcs_content():
         gcs_content = "Folder /gcs does not exist"
     return gcs_content
 
+async def ndjson_stream(chunks):
+    # one JSON object per line, flushed as soon as the LLM sends a chunk
+    async for chunk in chunks:
+        yield json.dumps({"text": chunk}, ensure_ascii=False) + "\n"
+    yield json.dumps({"done": True}) + "\n"
+
+class NdjsonResponse(StreamingResponse):
+    # takes an llm_limiter slot when built (503 when none is free) and
+    # releases it once the response is over, also when the client left
+    # before the stream was started
+    def __init__(self, chunks):
+        llm_limiter.acquire()
+        super().__init__(ndjson_stream(chunks), media_type="application/x-ndjson")
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            llm_limiter.release()
+
+async def strip_bold(chunks):
+    # same as response.replace("**", "") when "**" is split across chunks
+    pending = ""
+    async for chunk in chunks:
+        text = (pending + chunk).replace("**", "")
+        pending = ""
+        if text.endswith("*"):
+            text, pending = text[:-1], "*"
+        if text:
+            yield text
+    if pending:
+        yield pending
+
+def infrags_instructions(instructions, infrags, language):
+    context = "\n".join(
+      [f"- {m['text']} (stocké le {m['storage_date']})" for m in infrags]
+    )
+    instructions += f"\nVoici les éléments d'information pertinents :\n{context}"
+    if (language == "en-US"):
+        instructions += f"\nPlease answer in English."
+    return instructions
+
 # endregion
 
 # region "Mappings"
@@ -178,6 +388,27 @@ def debug():
         "llm": chatbot.llm
     }
 
+@fast_api_app.get("/metrics")
+def get_metrics():
+    return {
+        "timestamp": f"{datetime.now().strftime('%Y-%m-%d@%H-%M-%S')}",
+        "embedder": infrag_store.embedder.model_stats(),
+        "query_cache": infrag_store.embedder.query_cache_stats(),
+        "embedding_scheduler": infrag_store.embedder.scheduler.stats() if infrag_store.embedder.scheduler else None,
+        "index": infrag_store.check_consistency(),
+        "vector_index": infrag_store.index_status(),
+        "generation": infrag_store.generation_status(),
+        "tiered_storage": infrag_store.tiered.stats() if infrag_store.tiered else None,
+        "embedding_executor": embedding_executor.stats(),
+        "llm": llm_limiter.stats(),
+        "llm_cache": chatbot.cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "tts_cache": tts_cache.stats(),
+        "tts_executor": tts_executor.stats(),
+        "stt": speech_to_text.stats(),
+        "stt_executor": stt_executor.stats(),
+    }
+
 @fast_api_app.get("/config")
 def get_config():
     file_path = "data/config.json"
@@ -194,11 +425,12 @@ def get_config():
 # region "v2"
 
 @fast_api_app.post("/v2/infrags/add")
-def add_infrag(query: StoreInfragQuery):
+async def add_infrag(query: StoreInfragQuery):
     # create a timestamp with the current date
     ts = datetime.now().strftime("%Y-%m-%d")
     # call the add_infrag of the infrag_store object with the user_id, user_context, infrag (infomation fragment) and a timestamp
-    infrag_store.add_infrag(
+    await embedding_executor.run(
+        infrag_store.add_infrag,
         user_id=query.user_id,
         user_context=query.user_context,
         text=query.infrag,
@@ -206,77 +438,217 @@ def add_infrag(query: StoreInfragQuery):
     )
     return {"text": "Information fragment added successfully!"}
 
-@fast_api_app.get("/v2/infrags")
-def get_infrags():
-    file_path = "infrags_mgr/data/infrags.json"
-    if (get_is_local() != True):
-        file_path = "/gcs/voiceagent/infrags.json"
-    with open(file_path, "r") as infrags_file:
-        infrags = infrags_file.read()
-        infrags = re.sub(r"\n *", "", infrags)
-        infrags = json.loads(infrags)
-    return JSONResponse(
-        content={"infrags": infrags},
-        media_type="application/json; charset=utf-8"
+# Imports many fragments in one request, body in NDJSON or as a JSON
+# array of {"user_id", "user_context", "text", "storage_date"?} objects.
+# Fragments are embedded and written by batches of BULK_BATCH_SIZE
+# while the body is still being received. A batch waits up to
+# BULK_CAPACITY_WAIT seconds for the embedding executor; past that it and
+# the following ones are reported as errors, the statuses of the batches
+# already written are always returned.
+@fast_api_app.post("/v2/infrags/bulk")
+async def bulk_add_infrags(request: Request):
+    ts = datetime.now().strftime("%Y-%m-%d")
+    batch_size = int(os.getenv("BULK_BATCH_SIZE", "256"))
+    capacity_wait = float(os.getenv("BULK_CAPACITY_WAIT", "30"))
+    start = time.perf_counter()
+    parser = BulkParser()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    statuses = []
+    batch = []  # (index in statuses, fragment)
+    refused = None  # CapacityExceeded once the executor stayed full
+
+    async def add_batch():
+        deadline = time.monotonic() + capacity_wait
+        while True:
+            try:
+                return await embedding_executor.run(
+                    infrag_store.add_infrags, [fragment for _, fragment in batch], ts
+                )
+            except CapacityExceeded as e:
+                if time.monotonic() + e.retry_after > deadline:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+    async def flush():
+        nonlocal refused
+        if not batch:
+            return
+        try:
+            if refused is not None:
+                raise refused
+            ids = await add_batch()
+            for (index, _), infrag_id in zip(batch, ids):
+                statuses[index] = {"index": index, "status": "ok", "id": infrag_id}
+        except CapacityExceeded as e:
+            refused = e
+            for index, _ in batch:
+                statuses[index] = {"index": index, "status": "error", "error": str(e), "retry_after": e.retry_after}
+        except Exception as e:
+            for index, _ in batch:
+                statuses[index] = {"index": index, "status": "error", "error": str(e)}
+        batch.clear()
+
+    async def collect(results):
+        for item, error in results:
+            index = len(statuses)
+            fragment = None
+            if error is None:
+                fragment, error = validate_item(item)
+            if error is not None:
+                statuses.append({"index": index, "status": "error", "error": error})
+                continue
+            statuses.append(None)
+            batch.append((index, fragment))
+            if len(batch) >= batch_size:
+                await flush()
+
+    async for chunk in request.stream():
+        await collect(parser.feed(decoder.decode(chunk)))
+    await collect(parser.feed(decoder.decode(b"", final=True)))
+    await collect(parser.close())
+    await flush()
+    infrag_store.compact_in_background()
+    seconds = time.perf_counter() - start
+    added = sum(1 for status in statuses if status["status"] == "ok")
+    return {
+        "items": statuses,
+        "added": added,
+        "errors": len(statuses) - added,
+        "seconds": round(seconds, 3),
+        "fragments_per_second": round(added / seconds, 1) if seconds else 0.0,
+    }
+
+def infrags_json_stream(limit=None, cursor=None, page_size=500, **filters):
+    # {"infrags": [...], "next_cursor": ...} written page by page, the
+    # store lock is only held while one page is copied
+    yield '{"infrags": ['
+    sent = 0
+    while True:
+        size = page_size if limit is None else min(page_size, limit - sent)
+        page, cursor = infrag_store.page_infrags(cursor=cursor, limit=size, **filters)
+        for infrag in page:
+            yield ("," if sent else "") + json.dumps(infrag, ensure_ascii=False)
+            sent += 1
+        if cursor is None or (limit is not None and sent >= limit):
+            break
+    yield f'], "next_cursor": {json.dumps(cursor)}}}'
+
+def infrags_response(user_id, user_context, date_from, date_to, cursor, limit, fields):
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit doit être positif")
+    return StreamingResponse(
+        infrags_json_stream(
+            limit=limit,
+            cursor=cursor or None,  # "?cursor=" is the first page
+            user_id=user_id,
+            user_context=user_context,
+            date_from=date_from,
+            date_to=date_to,
+            fields=[f.strip() for f in fields.split(",") if f.strip()] if fields else None,
+        ),
+        media_type="application/json; charset=utf-8",
     )
 
+# all fragments by default, or pages of `limit` fragments in id order:
+# pass the returned next_cursor (an id) as `cursor` to get the next one
+@fast_api_app.get("/v2/infrags")
+def get_infrags(
+    user_id: str = None,
+    user_context: str = None,
+    date_from: str = None,
+    date_to: str = None,
+    cursor: str = None,
+    limit: int = None,
+    fields: str = None,
+):
+    return infrags_response(user_id, user_context, date_from, date_to, cursor, limit, fields)
+
+# replaces all the fragments, they are embedded in the background while
+# the current ones keep being served (see /v2/infrags/generation)
 @fast_api_app.post("/v2/infrags")
 def post_infrags(file: UploadFile = File(...)):
     ts = datetime.now().strftime("%Y-%m-%d@%H-%M-%S")
-    infrags_path = "infrags_mgr/data/infrags.json"
-    if (get_is_local() == False):
-        infrags_path = "/gcs/voiceagent/infrags.json"
-    infrags_backup_path = infrags_path + f".{ts}.bak"
-    shutil.copy(infrags_path, infrags_backup_path)
-    #shutil.delete(infrags_path)
-    with open(infrags_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    try:
+        infrags = json.load(file.file)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"JSON invalide: {e}")
+    if not isinstance(infrags, list) or not all(
+        isinstance(i, dict) and "id" in i and isinstance(i.get("text"), str) for i in infrags
+    ):
+        raise HTTPException(status_code=400, detail="Une liste de fragments avec id et text est attendue")
+    infrag_store.check_writable()
+    infrags_path = infrag_store.json_path
+    # fold the mutation log into the file so the backup is complete
+    infrag_store.save_infrags()
+    if os.path.exists(infrags_path):
+        shutil.copy(infrags_path, infrags_path + f".{ts}.bak")
+    if not infrag_store.reload_infrags(infrags):
+        raise HTTPException(status_code=409, detail="Un rechargement est déjà en cours")
     return JSONResponse(
-        content={"message": "File uploaded successfully"},
+        content={"message": "File uploaded successfully", **infrag_store.generation_status()},
         media_type="application/json; charset=utf-8"
     )
 
 @fast_api_app.get("/v2/infrags/reload")
 def reload_infrags():
-    InfragStore.reload_infrags
+    # new generation built from the stored fragments, swapped in when ready
+    started = infrag_store.reload_infrags()
     return JSONResponse(
-        content={"message": "infrags reloaded successfully"},
+        content={
+            "message": "infrags reload started" if started else "infrags reload already running",
+            **infrag_store.generation_status(),
+        },
         media_type="application/json; charset=utf-8"
     )
 
+# durability barrier: returns once the fragments are in the bucket
+@fast_api_app.post("/v2/infrags/flush")
+async def flush_infrags():
+    flushed = await embedding_executor.run(infrag_store.flush)
+    return {
+        "flushed": flushed,
+        "tiered_storage": infrag_store.tiered.stats() if infrag_store.tiered else None,
+    }
+
+@fast_api_app.get("/v2/infrags/generation")
+def get_infrags_generation():
+    return infrag_store.generation_status()
+
 @fast_api_app.put("/v2/infrags/{infrag_id}")
-def update_infrag(infrag_id: str, query: UpdateInfragQuery):
+async def update_infrag(infrag_id: str, query: UpdateInfragQuery):
     try:
         # Vérifier que l'ID correspond
         if infrag_id != query.infrag_id:
             raise HTTPException(status_code=400, detail="ID mismatch")
 
         # Appeler la méthode update_infrag du store
-        success = infrag_store.update_infrag(
+        success = await embedding_executor.run(
+            infrag_store.update_infrag,
             infrag_id=query.infrag_id,
             user_id=query.user_id,
             user_context=query.user_context,
             new_text=query.new_text
         )
-        infrag_store.reload_infrags()
-        infrag_store.rebuild_index()
 
         if success:
             return {"text": "Fragment mis à jour avec succès!"}
         else:
             raise HTTPException(status_code=404, detail="Fragment non trouvé")
 
+    except (HTTPException, CapacityExceeded, StorageConflict):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors de la mise à jour: {str(e)}")
 
 @fast_api_app.delete("/v2/infrags/{infrag_id}")
-def delete_infrag(infrag_id: str, user_id: str, user_context: str):
+async def delete_infrag(infrag_id: str, user_id: str, user_context: str):
     try:
         #user_id = request.args.get('user_id')
         #user_context = request.args.get('user_context')
         # Appeler la méthode delete_infrag du store
         #print(f"Deleting infrag with ID: {infrag_id}, user_id: {user_id}, user_context: {user_context}")
-        success = infrag_store.delete_infrag(
+        success = await embedding_executor.run(
+            infrag_store.delete_infrag,
             infrag_id=infrag_id,
             user_id=user_id,
             user_context=user_context
@@ -285,35 +657,38 @@ def delete_infrag(infrag_id: str, user_id: str, user_context: str):
             return {"text": "Fragment supprimé avec succès!"}
         else:
             raise HTTPException(status_code=404, detail="Fragment non trouvé")
+    except (HTTPException, CapacityExceeded, StorageConflict):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors de la suppression: {str(e)}")
 
 @fast_api_app.get("/v2/infrags/detailed")
-def get_infrags_detailed(user_id: str = None, user_context: str = None):
-    try:
-        # Appeler une méthode pour récupérer les fragments avec filtres
-        infrags = infrag_store.get_infrags_filtered(user_id=user_id, user_context=user_context)
-        return JSONResponse(
-            content={"infrags": infrags},
-            media_type="application/json; charset=utf-8"
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erreur lors de la récupération: {str(e)}")
+def get_infrags_detailed(
+    user_id: str = None,
+    user_context: str = None,
+    date_from: str = None,
+    date_to: str = None,
+    cursor: str = None,
+    limit: int = None,
+    fields: str = None,
+):
+    return infrags_response(user_id, user_context, date_from, date_to, cursor, limit, fields)
 
 # "/ask-llm" POST mapping
 @fast_api_app.post("/v2/ask-llm")
-def askLLM(query: LLMQuery):
+async def askLLM(query: LLMQuery):
     print("starting REST service ask-llm")
     print(f"language: {query.language}")
     response = "je ne sais rien, mais je dirai tout"
     if query.language == "en-US":
         query.instructions += "\nPlease answer in English."
-    response = chatbot.askLLM(
-        query.user_id,
-        query.instructions,
-        query.request,
-        query.language,
-    )
+    async with llm_limiter:
+        response = await chatbot.askLLMAsync(
+            query.user_id,
+            query.instructions,
+            query.request,
+            query.language,
+        )
     return JSONResponse(
         content={ "text": response },
         media_type="application/json; charset=utf-8"
@@ -321,35 +696,77 @@ def askLLM(query: LLMQuery):
 
 # "/ask-llm-providing-infrags" POST mapping
 @fast_api_app.post("/v2/ask-llm-providing-infrags")
-def askLLMProvidingInfrags(query: LLMProvidingInfragsQuery):
+async def askLLMProvidingInfrags(query: LLMProvidingInfragsQuery):
     print("starting REST service ask-llm-providing-infrags")
     response = "je ne sais rien, mais je dirai tout"
-    infrags = infrag_store.search_infrags(
+    infrags, vec, version = await embedding_executor.run(
+        infrag_store.search_infrags_with_vector,
         query.user_id,
         query.user_context,
         query.request,
         query.language,
+        mode=query.search_mode,
     )
-    context = "\n".join(
-      [f"- {m['text']} (stocké le {m['storage_date']})" for m in infrags]
-    )
-    instructions = query.instructions
-    instructions += f"\nVoici les éléments d'information pertinents :\n{context}"
+    tenant = (query.user_id, query.user_context)
+    scope = ("ask-llm-providing-infrags", query.instructions, query.language)
+    # answered by the keyword search alone (vec is None): same terms, same answer
+    terms = tokenize(query.request)
+    cached = semantic_cache.lookup(tenant, scope, vec, version, terms)
+    if cached is not None:
+        return JSONResponse(
+            content={ "text": cached },
+            media_type="application/json; charset=utf-8"
+        )
+    instructions = infrags_instructions(query.instructions, infrags, query.language)
     print(instructions)
-    if (query.language == "en-US"):
-        instructions += f"\nPlease answer in English."
-    response = chatbot.queryInfrags(
-        query.request,
-        instructions,
-        infrags,
-        language=query.language
-    )
+    async with llm_limiter:
+        response = await chatbot.queryInfragsAsync(
+            query.request,
+            instructions,
+            infrags,
+            language=query.language
+        )
     response = response.replace("**", "")
+    if not response.startswith(CachedChatbot.ERROR_PREFIX):
+        semantic_cache.store(tenant, scope, vec, version, response, terms)
     return JSONResponse(
         content={ "text": response },
         media_type="application/json; charset=utf-8"
     )
 
+@fast_api_app.post("/v2/ask-llm/stream")
+async def askLLMStream(query: LLMQuery):
+    print("starting REST service ask-llm/stream")
+    if query.language == "en-US":
+        query.instructions += "\nPlease answer in English."
+    chunks = chatbot.askLLMStream(
+        query.user_id,
+        query.instructions,
+        query.request,
+        query.language,
+    )
+    return NdjsonResponse(chunks)
+
+@fast_api_app.post("/v2/ask-llm-providing-infrags/stream")
+async def askLLMProvidingInfragsStream(query: LLMProvidingInfragsQuery):
+    print("starting REST service ask-llm-providing-infrags/stream")
+    infrags = await embedding_executor.run(
+        infrag_store.search_infrags,
+        query.user_id,
+        query.user_context,
+        query.request,
+        query.language,
+        mode=query.search_mode,
+    )
+    instructions = infrags_instructions(query.instructions, infrags, query.language)
+    chunks = chatbot.queryInfragsStream(
+        query.request,
+        instructions,
+        infrags,
+        language=query.language
+    )
+    return NdjsonResponse(strip_bold(chunks))
+
 # endregion
 
 # region "v1"
@@ -358,7 +775,7 @@ def askLLMProvidingInfrags(query: LLMProvidingInfragsQuery):
 def askV1(query: Query):
     response = "je sais pas"
     question = query.text
-    memories = store.search_memories(query.text) # add user_id and user_context
+    memories = get_memory_store().search_memories(query.text) # add user_id and user_context
     response = chatbot.ask(question, memories) # add instructions
     responseJson = {"text": response}
     return JSONResponse(
@@ -369,11 +786,11 @@ def askV1(query: Query):
 @fast_api_app.post("v1/store")
 def add_memory(query: Query):
     ts = datetime.now().strftime("%Y-%m-%d")
-    store.add_memory(query.text, ts) # add user_id and user_context
+    get_memory_store().add_memory(query.text, ts) # add user_id and user_context
     return {"text": "Memory added successfully!"}
 
 @fast_api_app.post("/v2/ask")
-def askV2(query: AskQuery):
+async def askV2(query: AskQuery):
     print("starting ask V2")
     # default response
     response = "je ne sais rien, mais je dirai tout"
@@ -383,22 +800,38 @@ def askV2(query: AskQuery):
     # that are relevant to the question
     # this will return a list of information fragments
     # that are relevant to the question
-    infrags = infrag_store.search_infrags(
+    infrags, vec, version = await embedding_executor.run(
+        infrag_store.search_infrags_with_vector,
         query.user_id,
         query.user_context,
         query.question,
         query.language,
+        mode=query.search_mode,
     )
+    # a near-duplicate question asked on the same fragments gets the same answer
+    tenant = (query.user_id, query.user_context)
+    scope = ("ask", query.instructions, query.language)
+    # answered by the keyword search alone (vec is None): same terms, same answer
+    terms = tokenize(query.question)
+    cached = semantic_cache.lookup(tenant, scope, vec, version, terms)
+    if cached is not None:
+        return JSONResponse(
+            content={"text": cached},
+            media_type="application/json; charset=utf-8"
+        )
     # call the queryInfrags method of the chatbot object
     # with the question, instructions and the list of information fragments
     # to get the answer to the question
     # this will return the answer to the question
-    response = chatbot.queryInfrags(
-        query.question,
-        query.instructions,
-        infrags,
-        query.language
-    )
+    async with llm_limiter:
+        response = await chatbot.queryInfragsAsync(
+            query.question,
+            query.instructions,
+            infrags,
+            query.language
+        )
+    if not response.startswith(CachedChatbot.ERROR_PREFIX):
+        semantic_cache.store(tenant, scope, vec, version, response, terms)
     # return the answer to the question in a JSON object looking like {"text": "ceci est un test"}
     responseJson = {"text": response}
     return JSONResponse(
@@ -406,27 +839,48 @@ def askV2(query: AskQuery):
         media_type="application/json; charset=utf-8"
     )
 
+@fast_api_app.post("/v2/ask/stream")
+async def askV2Stream(query: AskQuery):
+    print("starting ask V2 stream")
+    infrags = await embedding_executor.run(
+        infrag_store.search_infrags,
+        query.user_id,
+        query.user_context,
+        query.question,
+        query.language,
+        mode=query.search_mode,
+    )
+    chunks = chatbot.queryInfragsStream(
+        query.question,
+        query.instructions,
+        infrags,
+        query.language
+    )
+    return NdjsonResponse(chunks)
+
 # endregion
 
 # region "Speech to Text and Text to Speech"
 
 @fast_api_app.post("/text-to-speech")
-def tts_gtts(query: Query):
+async def tts_gtts(query: Query, request: Request):
     print("starting REST service text-to-speech")
     print("language: ", query.language)
-    ts = datetime.now().strftime("%Y-%m-%d@%H-%M-%S")
-    upload_dir = "uploaded_files"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_path = os.path.join(upload_dir, f"response_{ts}.mp3")
-    tts = gTTS(query.text, lang=query.language, slow=False)
-    tts.save(file_path)
-    size_in_bytes = os.path.getsize(file_path)
-    print(f"File saved at {file_path} with size {size_in_bytes} bytes")
-    return FileResponse(file_path, media_type='audio/mpeg')
+    # the same phrase always gives the same audio, the cache key is its ETag
+    etag = f'"{tts_cache.make_key(query.text, query.language, query.voice_type)}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    _, data, file_path = await tts_executor.run(
+        tts_cache.get, query.text, query.language, query.voice_type
+    )
+    if data is None:
+        return FileResponse(file_path, media_type="audio/mpeg", headers=headers)
+    return Response(content=data, media_type="audio/mpeg", headers=headers)
 
 # "/speech-to-text URL mapping (returns text in JSON)
 @fast_api_app.post("/speech-to-text")
-def stt(
+async def stt(
     file: UploadFile = File(...),
     language: str = Form(...)
 ):
@@ -434,30 +888,21 @@ def stt(
     print("language: ", language)
     text = ""
     try:
-        ts = datetime.now().strftime("%Y-%m-%d@%H-%M-%S")
-        if (file.content_type != "audio/mpeg"):
-            text = "Invalid file type"
-        upload_dir = "uploaded_files"
-        os.makedirs(upload_dir, exist_ok=True)
-        file_ext = os.path.splitext(file.filename)[1]
-        file_filename = os.path.splitext(file.filename)[0]
-        # print(f"file_ext: {file_ext}")
-        # print(f"file.filename: {file.filename}")
-        file_path = os.path.join(upload_dir, f"{file_filename}_{ts}{file_ext}")
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        recognizer = sr.Recognizer()
-        with sr.AudioFile(file_path) as source:
-            audio = recognizer.record(source)
-        text = recognizer.recognize_google(
-            audio, language=language
+        # {"text", "segments", "failed_segments"}, the text of the
+        # segments that could be recognized when some fail
+        return await stt_executor.run(
+            speech_to_text.transcribe, file.file, language, file.filename
         )
+    except AudioTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"Fichier audio trop volumineux (max {e.max_bytes} octets)")
+    except CapacityExceeded:
+        raise
     except sr.UnknownValueError:
         text = "Could not understand the audio."
     except sr.RequestError as e:
         text = f"request error: {e}"
     except Exception as e:
-        text = f"Error saving file: {e}"
+        text = f"Error reading audio: {e}"
     return {"text": text}
 
 # endregion
@@ -0,0 +1,147 @@
+import math
+import faiss
+import numpy as np
+
+# This class describes the index of a vector partition: "flat" is the
+# exact search, "hnsw" and "ivf" are approximate indexes that a
+# partition builds once it holds promote_at fragments (smaller ones stay
+# exact, the approximate index would not be faster). ef_search (HNSW)
+# and nprobe (IVF) trade recall for latency, see ann_report.
+# With a quantizer ("fp16" or "int8") the partition keeps its vectors as
+# scalar quantized codes once it holds quantize_at fragments (the int8
+# ranges are trained on them) and re-ranks rerank * k candidates with
+# the exact float32 vectors.
+class AnnConfig:
+
+    KINDS = ("flat", "hnsw", "ivf")
+    QUANTIZERS = {
+        "fp16": faiss.ScalarQuantizer.QT_fp16,
+        "int8": faiss.ScalarQuantizer.QT_8bit,
+    }
+    FIELDS = (
+        "kind", "promote_at", "hnsw_m", "ef_construction", "ef_search", "nlist", "nprobe", "rebuild_ratio",
+        "quantizer", "quantize_at", "rerank",
+    )
+
+    def __init__(
+        self,
+        kind="flat",
+        promote_at=10000,
+        hnsw_m=32,
+        ef_construction=40,
+        ef_search=64,
+        nlist=None, # None: sqrt of the partition size
+        nprobe=8,
+        # share of removed/replaced vectors after which the index is rebuilt
+        rebuild_ratio=0.25,
+        quantizer=None,
+        quantize_at=256,
+        rerank=4,
+    ):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown index kind {kind!r}, expected one of {self.KINDS}")
+        if quantizer is not None and quantizer not in self.QUANTIZERS:
+            raise ValueError(f"unknown quantizer {quantizer!r}, expected one of {tuple(self.QUANTIZERS)}")
+        self.kind = kind
+        self.promote_at = promote_at
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rebuild_ratio = rebuild_ratio
+        self.quantizer = quantizer
+        self.quantize_at = quantize_at
+        self.rerank = rerank
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{name: values[name] for name in cls.FIELDS if name in values})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def promotes(self, size):
+        return self.kind != "flat" and size >= max(1, self.promote_at)
+
+    def quantizes(self, size):
+        return self.quantizer is not None and size >= max(1, self.quantize_at)
+
+    # int8 ranges come from the vectors seen at training, with a margin
+    # for the ones added later (values outside are clipped)
+    def set_ranges(self, sq):
+        if self.quantizer == "int8":
+            sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+            sq.rangestat_arg = 0.1
+
+    # exact storage of a quantized partition, searched by ids
+    def storage(self, vectors, ids, dim):
+        vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, dim)
+        sq = faiss.IndexScalarQuantizer(dim, self.QUANTIZERS[self.quantizer], faiss.METRIC_L2)
+        self.set_ranges(sq.sq)
+        sq.train(vectors)
+        index = faiss.IndexIDMap2(sq)
+        index.add_with_ids(vectors, np.ascontiguousarray(ids, dtype="int64"))
+        return index
+
+    def list_count(self, size):
+        nlist = self.nlist or int(math.sqrt(size))
+        # IVF training wants a few dozen vectors per list
+        return max(1, min(nlist, size // 39))
+
+    # approximate index over vectors, searched by ids
+    def build(self, vectors, ids, dim):
+        vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, dim)
+        ids = np.ascontiguousarray(ids, dtype="int64")
+        if self.kind == "hnsw":
+            if self.quantizer:
+                hnsw = faiss.IndexHNSWSQ(dim, self.QUANTIZERS[self.quantizer], self.hnsw_m)
+                self.set_ranges(faiss.downcast_index(hnsw.storage).sq)
+                hnsw.train(vectors)
+            else:
+                hnsw = faiss.IndexHNSWFlat(dim, self.hnsw_m)
+            hnsw.hnsw.efConstruction = self.ef_construction
+            index = faiss.IndexIDMap(hnsw)
+        elif self.kind == "ivf":
+            nlist = self.list_count(len(vectors))
+            if self.quantizer:
+                index = faiss.IndexIVFScalarQuantizer(
+                    faiss.IndexFlatL2(dim), dim, nlist, self.QUANTIZERS[self.quantizer], faiss.METRIC_L2
+                )
+                self.set_ranges(index.sq)
+            else:
+                index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist)
+            index.train(vectors)
+        else:
+            raise ValueError("a flat partition has no approximate index")
+        index.add_with_ids(vectors, ids)
+        self.tune(index)
+        return index
+
+    # search parameters only, the index does not need a rebuild
+    def tune(self, index):
+        if self.kind == "hnsw":
+            faiss.downcast_index(index.index).hnsw.efSearch = self.ef_search
+        elif self.kind == "ivf":
+            index.nprobe = self.nprobe
+
+    # same structure (a tuned index can be kept), maybe other search parameters
+    def same_structure(self, other):
+        return (
+            self.kind == other.kind
+            and self.hnsw_m == other.hnsw_m
+            and self.ef_construction == other.ef_construction
+            and self.nlist == other.nlist
+            and self.quantizer == other.quantizer
+        )
+
+    # rough resident size of one vector in an index built from this config
+    def vector_bytes(self, dim, ann=False):
+        code = dim * 4 if self.quantizer is None else dim * (2 if self.quantizer == "fp16" else 1)
+        if not ann:
+            # IndexIDMap2: id + reverse map entry
+            return code + 40
+        if self.kind == "hnsw":
+            # level 0 has 2 * M neighbours, upper levels add little
+            return code + 8 + 2 * self.hnsw_m * 4 + 8
+        return code + 8
@@ -0,0 +1,125 @@
+import argparse
+import json
+import time
+import numpy as np
+from infrags_mgr.ann_index import AnnConfig
+from infrags_mgr.vector_partition import VectorPartition
+
+# Recall@k, latency and memory per vector of the approximate and
+# quantized partition indexes against the exact (flat, float32) search, to
+# choose INFRAGS_INDEX, INFRAGS_HNSW_EF_SEARCH, INFRAGS_IVF_NPROBE,
+# INFRAGS_QUANTIZER and INFRAGS_RERANK. The vectors are synthetic
+# clusters of unit vectors like sentence embeddings, or the embeddings
+# of a fragments file.
+#   python -m infrags_mgr.ann_report --vectors 50000 --ef-search 16 32 64 128 --nprobe 1 4 8 16
+#   python -m infrags_mgr.ann_report --quantizer int8 --rerank 1 4 --ef-search 64 --nprobe 8
+#   python -m infrags_mgr.ann_report --infrags infrags_mgr/data/infrags.json
+
+def normalize(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype("float32")
+
+def synthetic_vectors(count, dim, clusters, rng):
+    centers = normalize(rng.standard_normal((clusters, dim)))
+    labels = rng.integers(0, clusters, count)
+    return normalize(centers[labels] + 0.08 * rng.standard_normal((count, dim)))
+
+def infrags_vectors(path):
+    from infrags_mgr.embedder import get_embedder
+    with open(path, "r", encoding="utf-8") as f:
+        texts = [infrag["text"] for infrag in json.load(f)]
+    return np.asarray(get_embedder().embed_many(texts), dtype="float32")
+
+def make_partition(vectors, config):
+    # re-ranking reads the float32 vectors, from disk in the store
+    partition = VectorPartition(vectors.shape[1], config, lambda infrags: [vectors[i["id"]] for i in infrags])
+    start = time.perf_counter()
+    partition.add_many([{"id": pos} for pos in range(len(vectors))], vectors)
+    return partition, time.perf_counter() - start
+
+def run(partition, queries, k):
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        found = partition.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        results.append({infrag["id"] for infrag in found})
+    return results, np.array(latencies) * 1000
+
+def report(name, partition, build_seconds, latencies, results, exact, k):
+    recall = np.mean([len(found & truth) / max(1, min(k, len(truth))) for found, truth in zip(results, exact)])
+    memory = partition.memory()
+    print(
+        f"{name:<32} build={build_seconds:7.2f}s recall@{k}={recall:.3f} "
+        f"mean={latencies.mean():.3f}ms p95={np.percentile(latencies, 95):.3f}ms "
+        f"bytes/vector={memory['bytes'] / memory['vectors']:.0f}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--infrags", help="fragments file to embed instead of synthetic vectors")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[16, 32, 64, 128])
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 4, 8, 16])
+    parser.add_argument("--quantizer", choices=sorted(AnnConfig.QUANTIZERS), help="quantize every index of the report")
+    parser.add_argument("--rerank", type=int, nargs="+", default=[4])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    if args.infrags:
+        vectors = infrags_vectors(args.infrags)
+    else:
+        vectors = synthetic_vectors(args.vectors, args.dim, args.clusters, rng)
+    # queries close to stored fragments, as questions are to their answers
+    picked = vectors[rng.integers(0, len(vectors), args.queries)]
+    queries = normalize(picked + 0.05 * rng.standard_normal(picked.shape))
+    print(f"vectors={len(vectors)} dim={vectors.shape[1]} queries={len(queries)} k={args.k}")
+
+    flat, build_seconds = make_partition(vectors, AnnConfig("flat"))
+    exact, latencies = run(flat, queries, args.k)
+    report("flat", flat, build_seconds, latencies, exact, exact, args.k)
+
+    quantizer = args.quantizer
+    suffix = f" {quantizer}" if quantizer else ""
+    if quantizer:
+        config = AnnConfig("flat", quantizer=quantizer, quantize_at=1)
+        partition, build_seconds = make_partition(vectors, config)
+        for rerank in args.rerank:
+            config.rerank = rerank
+            results, latencies = run(partition, queries, args.k)
+            report(f"flat{suffix} rerank={rerank}", partition, build_seconds, latencies, results, exact, args.k)
+
+    if args.ef_search:
+        config = AnnConfig(
+            "hnsw", promote_at=1, hnsw_m=args.hnsw_m, ef_search=args.ef_search[0], quantizer=quantizer, quantize_at=1
+        )
+        hnsw, build_seconds = make_partition(vectors, config)
+        for ef_search in args.ef_search:
+            config.ef_search = ef_search
+            config.tune(hnsw.ann)
+            for rerank in args.rerank if quantizer else [None]:
+                config.rerank = rerank
+                name = f"hnsw{suffix} M={args.hnsw_m} ef={ef_search}" + (f" rerank={rerank}" if rerank else "")
+                results, latencies = run(hnsw, queries, args.k)
+                report(name, hnsw, build_seconds, latencies, results, exact, args.k)
+
+    if args.nprobe:
+        config = AnnConfig("ivf", promote_at=1, nlist=args.nlist, nprobe=args.nprobe[0], quantizer=quantizer, quantize_at=1)
+        ivf, build_seconds = make_partition(vectors, config)
+        for nprobe in args.nprobe:
+            config.nprobe = nprobe
+            config.tune(ivf.ann)
+            for rerank in args.rerank if quantizer else [None]:
+                config.rerank = rerank
+                name = f"ivf{suffix} nlist={ivf.ann.nlist} nprobe={nprobe}" + (f" rerank={rerank}" if rerank else "")
+                results, latencies = run(ivf, queries, args.k)
+                report(name, ivf, build_seconds, latencies, results, exact, args.k)
+
+if __name__ == "__main__":
+    main()
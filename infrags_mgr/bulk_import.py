@@ -0,0 +1,94 @@
+import json
+
+# This class turns a request body received in chunks into items, as
+# soon as each one is complete, so a large import is never held in
+# memory as a whole. The body is either NDJSON (one object per line)
+# or a JSON array of objects.
+# feed() and close() return a list of (item, error) pairs, error is
+# None when the item could be decoded.
+class BulkParser:
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.format = None  # "array" or "ndjson", from the first character
+        self.done = False
+
+    def feed(self, text):
+        self.buffer += text
+        if self.format is None:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return []
+            if stripped[0] == "[":
+                self.format = "array"
+                self.buffer = stripped[1:]
+            else:
+                self.format = "ndjson"
+        if self.format == "array":
+            return self.parse_array(final=False)
+        return self.parse_lines(final=False)
+
+    def close(self):
+        if self.format == "array":
+            results = self.parse_array(final=True)
+            if not self.done:
+                results.append((None, "tableau JSON incomplet"))
+            return results
+        return self.parse_lines(final=True)
+
+    def parse_lines(self, final):
+        lines = self.buffer.split("\n")
+        self.buffer = "" if final else lines.pop()
+        results = []
+        for line in lines:
+            line = line.strip()
+            if line:
+                results.append(self.decode(line))
+        return results
+
+    def decode(self, text):
+        try:
+            return json.loads(text), None
+        except json.JSONDecodeError as e:
+            return None, f"JSON invalide: {e}"
+
+    def parse_array(self, final):
+        results = []
+        while not self.done:
+            rest = self.buffer.lstrip().lstrip(",").lstrip()
+            if rest.startswith("]"):
+                self.done = True
+                self.buffer = ""
+                break
+            if not rest:
+                self.buffer = ""
+                break
+            try:
+                item, end = self.decoder.raw_decode(rest)
+            except json.JSONDecodeError as e:
+                self.buffer = rest
+                if final:
+                    # nothing more to come, the array cannot be resumed
+                    results.append((None, f"JSON invalide: {e}"))
+                    self.done = True
+                break
+            results.append((item, None))
+            self.buffer = rest[end:]
+        return results
+
+# Checks one decoded item, returns (fragment, error). The text may be
+# given as "text" or, like /v2/infrags/add, as "infrag".
+def validate_item(item):
+    if not isinstance(item, dict):
+        return None, "un objet JSON est attendu"
+    text = item.get("text", item.get("infrag"))
+    for name, value in (("user_id", item.get("user_id")), ("user_context", item.get("user_context")), ("text", text)):
+        if not isinstance(value, str) or not value.strip():
+            return None, f"champ {name} manquant"
+    return {
+        "user_id": item["user_id"],
+        "user_context": item["user_context"],
+        "text": text,
+        "storage_date": item.get("storage_date"),
+    }, None
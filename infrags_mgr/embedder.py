@@ -1,9 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 from sentence_transformers import SentenceTransformer
+from infrags_mgr.embedding_scheduler import EmbeddingScheduler
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'  # léger et efficace
 
 class Embedder:
 
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')  # léger et efficace
+    def __init__(
+        self,
+        model_name=DEFAULT_MODEL,
+        batch_size=64,
+        query_cache_max_bytes=8 * 1024 * 1024,
+        query_cache_ttl=3600,
+    ):
+        self.model_name = model_name
+        # the model is loaded on first use (or by warm_up)
+        self._model = None
+        self.model_lock = threading.Lock()
+        self.encode_lock = threading.Lock()
+        self.load_seconds = None
+        self.model_bytes = None
+        self.batch_size = batch_size
+        # groups concurrent embed() calls into batches, see enable_scheduler
+        self.scheduler = None
+        # LRU cache of query text -> (vector, insertion time)
+        self.query_cache = OrderedDict()
+        self.query_cache_lock = threading.Lock()
+        self.query_cache_max_bytes = query_cache_max_bytes
+        self.query_cache_ttl = query_cache_ttl
+        self.query_cache_bytes = 0
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self.model_lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    model = SentenceTransformer(self.model_name)
+                    self.load_seconds = time.perf_counter() - start
+                    self.model_bytes = self.parameters_size(model)
+                    print(f"Modèle {self.model_name} chargé en {self.load_seconds:.1f}s")
+                    self._model = model
+        return self._model
+
+    @staticmethod
+    def parameters_size(model):
+        try:
+            return sum(p.numel() * p.element_size() for p in model.parameters())
+        except Exception:
+            return None
+
+    def warm_up(self, background=True):
+        # load the model before the first request needs it
+        if background:
+            threading.Thread(target=lambda: self.model, daemon=True).start()
+        else:
+            self.model
+
+    def model_stats(self):
+        return {
+            "model": self.model_name,
+            "loaded": self._model is not None,
+            "load_seconds": self.load_seconds,
+            "model_bytes": self.model_bytes,
+        }
+
+    def encode(self, texts, **kwargs):
+        model = self.model
+        with self.encode_lock:
+            return model.encode(texts, **kwargs)
+
+    def enable_scheduler(self, max_wait=0.005, max_batch=32):
+        if self.scheduler is None:
+            self.scheduler = EmbeddingScheduler(self, max_wait, max_batch)
+        return self.scheduler
 
     def embed(self, text):
-        return self.model.encode([text])[0]
+        if self.scheduler is not None:
+            return self.scheduler.embed(text)
+        return self.encode([text])[0]
+
+    @staticmethod
+    def normalize_query(text):
+        return " ".join(text.split()).casefold()
+
+    # This method embeds a user question, repeated questions are
+    # answered from the query cache without running the model.
+    def embed_query(self, text):
+        key = self.normalize_query(text)
+        now = time.monotonic()
+        with self.query_cache_lock:
+            entry = self.query_cache.get(key)
+            if entry is not None:
+                vec, created = entry
+                if now - created <= self.query_cache_ttl:
+                    self.query_cache.move_to_end(key)
+                    self.query_cache_hits += 1
+                    return vec
+                self._drop_query(key)
+            self.query_cache_misses += 1
+        vec = np.array(self.embed(text), dtype="float32")
+        vec.setflags(write=False)
+        with self.query_cache_lock:
+            if key in self.query_cache:
+                self._drop_query(key)
+            self.query_cache[key] = (vec, now)
+            self.query_cache_bytes += vec.nbytes + len(key)
+            while self.query_cache_bytes > self.query_cache_max_bytes and self.query_cache:
+                self._drop_query(next(iter(self.query_cache)))
+        return vec
+
+    def _drop_query(self, key):
+        vec, _ = self.query_cache.pop(key)
+        self.query_cache_bytes -= vec.nbytes + len(key)
+
+    def query_cache_stats(self):
+        with self.query_cache_lock:
+            lookups = self.query_cache_hits + self.query_cache_misses
+            return {
+                "entries": len(self.query_cache),
+                "bytes": self.query_cache_bytes,
+                "max_bytes": self.query_cache_max_bytes,
+                "ttl": self.query_cache_ttl,
+                "hits": self.query_cache_hits,
+                "misses": self.query_cache_misses,
+                "hit_rate": self.query_cache_hits / lookups if lookups else 0.0,
+            }
+
+    # This method embeds a list of texts in real batches.
+    # Texts are sorted by length so each batch pads to similar sizes,
+    # then the vectors are put back in the input order.
+    def embed_many(self, texts, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        if not texts:
+            # nothing to encode, do not load the model for that
+            return np.zeros((0, 384), dtype="float32")
+        vectors = np.zeros((len(texts), self.model.get_sentence_embedding_dimension()), dtype="float32")
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), batch_size):
+            positions = order[start:start + batch_size]
+            encoded = self.encode(
+                [texts[i] for i in positions],
+                batch_size=batch_size,
+                convert_to_numpy=True,
+            )
+            vectors[positions] = encoded
+        return np.ascontiguousarray(vectors)
+
+
+# process-wide embedders, one per model name, shared by all the stores
+_embedders = {}
+_embedders_lock = threading.Lock()
+
+def get_embedder(model_name=DEFAULT_MODEL):
+    with _embedders_lock:
+        embedder = _embedders.get(model_name)
+        if embedder is None:
+            embedder = Embedder(model_name)
+            _embedders[model_name] = embedder
+        return embedder
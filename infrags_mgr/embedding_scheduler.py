@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# This class groups the embed requests of concurrent callers into
+# batches. A worker thread takes the first waiting text, collects the
+# ones arriving within max_wait seconds (up to max_batch texts), encodes
+# them with one embed_many call and hands each caller its own vector.
+class EmbeddingScheduler:
+
+    BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+    def __init__(self, embedder, max_wait=0.005, max_batch=32):
+        self.embedder = embedder
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_histogram = {size: 0 for size in self.BATCH_BUCKETS}
+        self.batches = 0
+        self.texts = 0
+        self.max_queue_depth = 0
+        self.worker = threading.Thread(target=self.run, name="embedding-scheduler", daemon=True)
+        self.worker.start()
+
+    def embed(self, text):
+        future = Future()
+        self.queue.put((text, future))
+        depth = self.queue.qsize()
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+        return future.result()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                vectors = self.embedder.embed_many([text for text, _ in batch])
+                for (_, future), vec in zip(batch, vectors):
+                    future.set_result(vec)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            self.record(len(batch))
+
+    def record(self, size):
+        with self.lock:
+            self.batches += 1
+            self.texts += size
+            bucket = next((b for b in self.BATCH_BUCKETS if size <= b), self.BATCH_BUCKETS[-1])
+            self.batch_histogram[bucket] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_wait_ms": self.max_wait * 1000,
+                "max_batch": self.max_batch,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "batches": self.batches,
+                "texts": self.texts,
+                "avg_batch_size": self.texts / self.batches if self.batches else 0.0,
+                # batches of at most <bucket> texts
+                "batch_size_histogram": {str(b): n for b, n in self.batch_histogram.items()},
+            }
@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded pools used by the async request handlers. When a pool is full
+# the request is refused with CapacityExceeded (503 + Retry-After)
+# instead of waiting in an unbounded queue.
+
+class CapacityExceeded(Exception):
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} capacity exceeded")
+        self.name = name
+        self.retry_after = retry_after
+
+# This class runs blocking functions (model inference, file I/O) on a
+# dedicated thread pool. At most max_workers run at once and at most
+# max_queue more may wait for a worker.
+class BoundedExecutor:
+
+    def __init__(self, name, max_workers, max_queue, retry_after=1):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    def timed(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+                self.completed += 1
+
+    async def run(self, fn, *args, **kwargs):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise CapacityExceeded(self.name, self.retry_after)
+        with self.lock:
+            self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, functools.partial(self.timed, fn, *args, **kwargs)
+            )
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "pending": self.pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_seconds": self.busy_seconds / self.completed if self.completed else 0.0,
+            }
+
+# This class limits the number of concurrent async calls (LLM requests)
+# and refuses new ones once max_concurrent are in flight.
+#   async with llm_limiter:
+#       ...
+class AsyncLimiter:
+
+    def __init__(self, name, max_concurrent, retry_after=5):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def acquire(self):
+        # handlers all run on the event loop thread, no lock needed
+        if self.in_flight >= self.max_concurrent:
+            self.rejected += 1
+            raise CapacityExceeded(self.name, self.retry_after)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.completed += 1
+
+    async def __aenter__(self):
+        self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
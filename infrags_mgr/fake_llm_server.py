@@ -0,0 +1,90 @@
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# This is a stand-in for the OpenAI chat completions API, to try the
+# streaming endpoints without a real model:
+#   python -m infrags_mgr.fake_llm_server --port 8089 --delay 0.05
+#   LLM_PROVIDER=openai OPENAI_BASE_URL=http://localhost:8089/v1 \
+#     OPENAI_API_KEY=fake uvicorn api:fast_api_app --port 8000
+# The answer repeats the end of the prompt word by word, waiting
+# --delay seconds before each word (and --first-token-delay before the first).
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+
+    delay = 0.05
+    first_token_delay = 0.2
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer_words(self, body):
+        messages = body.get("messages") or [{"content": ""}]
+        prompt = " ".join(messages[-1].get("content", "").split())
+        return f"Réponse simulée : {prompt[-120:]}".split(" ")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        words = self.answer_words(body)
+        model = body.get("model", "fake")
+        time.sleep(self.first_token_delay)
+        if not body.get("stream"):
+            time.sleep(self.delay * len(words))
+            payload = json.dumps({
+                "id": "fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.delay)
+            chunk = {
+                "id": "fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": word if i == 0 else " " + word},
+                    "finish_reason": None,
+                }],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    args = parser.parse_args()
+    FakeLLMHandler.delay = args.delay
+    FakeLLMHandler.first_token_delay = args.first_token_delay
+    server = ThreadingHTTPServer(("0.0.0.0", args.port), FakeLLMHandler)
+    print(f"fake LLM server on http://0.0.0.0:{args.port}/v1")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import google.generativeai as genai
 import os
 
@@ -14,9 +15,11 @@ genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 class GoogleChatbot:
 
   #def __init__(self, model_name="gemini-1.5-flash"): # Modèle Gemini par défaut
-  def __init__(self, model_name="gemini-2.0-flash"): # Modèle Gemini par défaut
+  def __init__(self, model_name="gemini-2.0-flash", timeout=60): # Modèle Gemini par défaut
     self.model = genai.GenerativeModel(model_name)
     self.llm = "Google"
+    # seconds allowed for one call of the async methods
+    self.timeout = timeout
 
   # This method is used to ask a question to the chatbot
   # based on the user's memories.
@@ -54,19 +57,9 @@ class GoogleChatbot:
     print("response from chatbot: "+response)
     return response
 
-  # this method is used to ask a question to the chatbot
-  # based on the user's information fragments.
-  def queryInfrags(
-    self,
-    question,
-    instructions,
-    infrags,
-    language,
-  ):
-    print("starting chatbot queryInfrags")
-    print("chatbot is: "+self.llm)
-    print("language: "+language)
-    print("question to chatbot: "+question)
+  # builds the prompt used to answer a question
+  # from the user's information fragments.
+  def infragsPrompt(self, question, instructions, infrags):
     # concatenate the information fragments into a single string
     context = "\n".join(
       [f"- {m['text']} ({m['storage_date']})" for m in infrags]
@@ -80,6 +73,22 @@ class GoogleChatbot:
       en te basant sur les éléments d'information pertinents.
 
     """
+    return prompt
+
+  # this method is used to ask a question to the chatbot
+  # based on the user's information fragments.
+  def queryInfrags(
+    self,
+    question,
+    instructions,
+    infrags,
+    language,
+  ):
+    print("starting chatbot queryInfrags")
+    print("chatbot is: "+self.llm)
+    print("language: "+language)
+    print("question to chatbot: "+question)
+    prompt = self.infragsPrompt(question, instructions, infrags)
     generation_config = genai.types.GenerationConfig(temperature=0.7)
     try:
       gemini_response = self.model.generate_content(
@@ -114,3 +123,63 @@ class GoogleChatbot:
       response = "Désolé, une erreur est survenue lors de la génération de la réponse."
     print("response from chatbot ask-llm: "+response)
     return response
+
+  # async call to Gemini, bounded by self.timeout
+  async def generateAsync(self, prompt):
+    generation_config = genai.types.GenerationConfig(temperature=0.7)
+    try:
+      gemini_response = await asyncio.wait_for(
+        self.model.generate_content_async(
+          [prompt],
+          generation_config=generation_config,
+          request_options={"timeout": self.timeout}),
+        timeout=self.timeout)
+      response = gemini_response.text
+    except Exception as e:
+      print(f"Error calling Gemini API: {e}")
+      response = "Désolé, une erreur est survenue lors de la génération de la réponse."
+    return response
+
+  # async version of queryInfrags
+  async def queryInfragsAsync(self, question, instructions, infrags, language="fr-FR"):
+    print("starting chatbot queryInfragsAsync")
+    print("language: "+language)
+    response = await self.generateAsync(self.infragsPrompt(question, instructions, infrags))
+    print("response from chatbot: "+response)
+    return response
+
+  # async version of askLLM
+  async def askLLMAsync(self, user_id, instructions, request, language="fr-FR"):
+    print("starting chatbot askLLMAsync")
+    print("language: "+language)
+    response = await self.generateAsync(f"{instructions}\n{request}")
+    print("response from chatbot ask-llm: "+response)
+    return response
+
+  # yields the text of the answer chunk by chunk, as Gemini produces it
+  async def streamPrompt(self, prompt):
+    generation_config = genai.types.GenerationConfig(temperature=0.7)
+    try:
+      gemini_response = await self.model.generate_content_async(
+          [prompt],
+          generation_config=generation_config,
+          stream=True,
+          request_options={"timeout": self.timeout})
+      async for chunk in gemini_response:
+        if chunk.parts:
+          yield chunk.text
+    except Exception as e:
+      print(f"Error calling Gemini API: {e}")
+      yield "Désolé, une erreur est survenue lors de la génération de la réponse."
+
+  # streaming version of queryInfrags
+  def queryInfragsStream(self, question, instructions, infrags, language="fr-FR"):
+    print("starting chatbot queryInfragsStream")
+    print("language: "+language)
+    return self.streamPrompt(self.infragsPrompt(question, instructions, infrags))
+
+  # streaming version of askLLM
+  def askLLMStream(self, user_id, instructions, request, language="fr-FR"):
+    print("starting chatbot askLLMStream")
+    print("language: "+language)
+    return self.streamPrompt(f"{instructions}\n{request}")
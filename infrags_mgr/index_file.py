@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import faiss
+import numpy as np
+
+# Helpers to keep a FAISS index on disk next to the JSON it was built
+# from. A small "<index>.meta.json" file holds the fingerprint of the
+# corpus, the index is only reused as a whole when the fingerprint still
+# matches; with the key of every row (id + text hash) the rows of
+# unchanged records can be reused for another corpus.
+
+def corpus_fingerprint(records, fields=("id", "text")):
+    digest = hashlib.sha1()
+    for record in records:
+        digest.update(
+            json.dumps([record.get(f) for f in fields], ensure_ascii=False).encode("utf-8")
+        )
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def save_index(index, path, fingerprint, keys=None):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        meta = {"fingerprint": fingerprint, "ntotal": index.ntotal, "dim": index.d}
+        if keys is not None:
+            meta["keys"] = keys
+        json.dump(meta, f)
+    os.replace(tmp_path, path + ".meta.json")
+
+def read_index(path, accept):
+    # (index, meta) when the meta passes accept(meta), else (None, None)
+    meta_path = path + ".meta.json"
+    if not (os.path.exists(path) and os.path.exists(meta_path)):
+        return None, None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if not accept(meta):
+            return None, None
+        try:
+            # the OS pages the vectors in on demand
+            index = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+        except RuntimeError:
+            index = faiss.read_index(path)
+        if index.ntotal != meta.get("ntotal"):
+            return None, None
+        return index, meta
+    except Exception as e:
+        print(f"Index {path} ignoré: {e}")
+        return None, None
+
+def load_index(path, fingerprint):
+    index, _ = read_index(path, lambda meta: meta.get("fingerprint") == fingerprint)
+    return index
+
+# the saved index whatever its corpus and the key of each of its rows,
+# (None, None) when it was saved without keys
+def load_index_rows(path):
+    index, meta = read_index(path, lambda meta: len(meta.get("keys") or []) == meta.get("ntotal"))
+    if index is None:
+        return None, None
+    return index, meta["keys"]
+
+# Vectors shared by the uvicorn workers: one .npy file per corpus
+# fingerprint in a local directory, opened read-only with np.load
+# mmap_mode so every worker maps the same pages instead of holding its
+# own copy. Files of other fingerprints are removed when a new one is
+# written (workers still mapping them keep their pages until they swap).
+
+def shared_vectors_path(directory, fingerprint):
+    return os.path.join(directory, f"vectors.{fingerprint}.npy")
+
+def load_shared_vectors(directory, fingerprint, dim):
+    path = shared_vectors_path(directory, fingerprint)
+    if not os.path.exists(path):
+        return None
+    try:
+        vectors = np.load(path, mmap_mode="r")
+        if vectors.ndim != 2 or vectors.shape[1] != dim or vectors.dtype != np.float32:
+            return None
+        return vectors
+    except (OSError, ValueError) as e:
+        print(f"Vecteurs partagés {path} ignorés: {e}")
+        return None
+
+def save_shared_vectors(directory, fingerprint, vectors):
+    os.makedirs(directory, exist_ok=True)
+    path = shared_vectors_path(directory, fingerprint)
+    # several workers may write the same file, each one uses its own temporary file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(vectors, dtype="float32"))
+    os.replace(tmp_path, path)
+    for name in os.listdir(directory):
+        if name.startswith("vectors.") and name.endswith(".npy") and os.path.join(directory, name) != path:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return np.load(path, mmap_mode="r")
@@ -0,0 +1,325 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+
+# This class stores the information fragments in a SQLite database
+# (WAL mode) with their vectors as BLOBs next to the text.
+# It has the same methods as InfragLogStorage so InfragStore can use
+# either one. Lookups by tenant, id or date go through indexes.
+# The database must live on a local disk, not on the /gcs FUSE mount.
+# With change_feed=True every mutation is also written to a "changes"
+# table in the same transaction, so that several processes (uvicorn
+# workers) sharing the database can apply each other's writes.
+class InfragSqliteStorage:
+
+    COLUMNS = ("id", "user_id", "user_context", "text", "storage_date", "modified_date")
+    # changes kept for workers that are behind, older ones are pruned
+    KEEP_CHANGES = 10000
+
+    def __init__(self, db_path, json_path=None, dim=384, change_feed=False, origin=None):
+        self.db_path = db_path
+        # JSON file imported on first start and written by compact()
+        self.json_path = json_path
+        self.dim = dim
+        self.change_feed = change_feed
+        # written with each change, a process skips its own changes
+        self.origin = origin
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.create_schema()
+
+    def connection(self):
+        # one connection per thread, WAL lets readers run side by side
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def create_schema(self):
+        conn = self.connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS infrags (
+                    rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL,
+                    user_id TEXT,
+                    user_context TEXT,
+                    text TEXT NOT NULL,
+                    storage_date TEXT,
+                    modified_date TEXT,
+                    text_hash TEXT,
+                    vector BLOB
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_infrags_tenant ON infrags (user_id, user_context)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_infrags_id ON infrags (id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_infrags_storage_date ON infrags (storage_date)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    id TEXT,
+                    origin TEXT,
+                    infrag TEXT,
+                    vector BLOB
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def to_infrag(row):
+        infrag = {}
+        for name, value in zip(InfragSqliteStorage.COLUMNS, row):
+            if name == "modified_date" and value is None:
+                continue
+            infrag[name] = value
+        # ids are stored as text, give numeric ids back their int type
+        if infrag["id"].isdigit():
+            infrag["id"] = int(infrag["id"])
+        return infrag
+
+    def to_row(self, infrag, vec=None):
+        return (
+            str(infrag.get("id")),
+            infrag.get("user_id"),
+            infrag.get("user_context"),
+            infrag.get("text", ""),
+            infrag.get("storage_date"),
+            infrag.get("modified_date"),
+            self.text_hash(infrag.get("text", "")) if vec is not None else None,
+            np.asarray(vec, dtype="float32").tobytes() if vec is not None else None,
+        )
+
+    def load(self):
+        conn = self.connection()
+        count = conn.execute("SELECT COUNT(*) FROM infrags").fetchone()[0]
+        if count == 0 and self.json_path and os.path.exists(self.json_path):
+            with open(self.json_path, "r", encoding="utf-8") as f:
+                infrags = json.load(f)
+            with self.lock, conn:
+                # workers starting together import the file only once
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("SELECT COUNT(*) FROM infrags").fetchone()[0] == 0:
+                    self.insert(conn, infrags)
+        return self.select()
+
+    def insert(self, conn, infrags):
+        conn.executemany(
+            "INSERT INTO infrags (id, user_id, user_context, text, storage_date, modified_date, text_hash, vector)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [self.to_row(infrag) for infrag in infrags],
+        )
+
+    def select(self, user_id=None, user_context=None):
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM infrags"
+        clauses = []
+        params = []
+        if user_id:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if user_context:
+            clauses.append("user_context = ?")
+            params.append(user_context)
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY rowid"
+        rows = self.connection().execute(sql, params).fetchall()
+        return [self.to_infrag(row) for row in rows]
+
+    def load_vectors(self):
+        # VectorCache key -> vector for every row that has one
+        rows = self.connection().execute(
+            "SELECT id, text_hash, vector FROM infrags WHERE vector IS NOT NULL"
+        ).fetchall()
+        return {
+            f"{infrag_id}:{text_hash}": np.frombuffer(blob, dtype="float32").copy()
+            for infrag_id, text_hash, blob in rows
+            if len(blob) == self.dim * 4
+        }
+
+    # vectors of (infrag_id, text) pairs, None when the row has none for this text
+    def stored_vectors(self, pairs):
+        found = {}
+        conn = self.connection()
+        for start in range(0, len(pairs), 500):
+            ids = [str(infrag_id) for infrag_id, text in pairs[start:start + 500]]
+            rows = conn.execute(
+                f"SELECT id, text_hash, vector FROM infrags WHERE vector IS NOT NULL AND id IN ({','.join('?' * len(ids))})",
+                ids,
+            ).fetchall()
+            for infrag_id, text_hash, blob in rows:
+                if len(blob) == self.dim * 4:
+                    found[(infrag_id, text_hash)] = np.frombuffer(blob, dtype="float32").copy()
+        return [found.get((str(infrag_id), self.text_hash(text))) for infrag_id, text in pairs]
+
+    def record_add(self, infrag, vec=None):
+        self.record_add_many([infrag], [vec])
+
+    # one transaction for the whole batch
+    def record_add_many(self, infrags, vectors=None):
+        vectors = vectors if vectors is not None else [None] * len(infrags)
+        conn = self.connection()
+        with self.lock, conn:
+            conn.executemany(
+                "INSERT INTO infrags (id, user_id, user_context, text, storage_date, modified_date, text_hash, vector)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [self.to_row(infrag, vec) for infrag, vec in zip(infrags, vectors)],
+            )
+            self.log_changes(conn, [("add", infrag, vec) for infrag, vec in zip(infrags, vectors)])
+
+    def record_update(self, infrag, vec=None):
+        row = self.to_row(infrag, vec)
+        conn = self.connection()
+        with self.lock, conn:
+            # first row with this id, like the in-memory update
+            conn.execute(
+                "UPDATE infrags SET user_id = ?, user_context = ?, text = ?, storage_date = ?,"
+                " modified_date = ?, text_hash = ?, vector = ?"
+                " WHERE rowid = (SELECT rowid FROM infrags WHERE id = ? ORDER BY rowid LIMIT 1)",
+                row[1:] + (row[0],),
+            )
+            self.log_changes(conn, [("update", infrag, vec)])
+
+    def record_delete(self, infrag_ids):
+        conn = self.connection()
+        with self.lock, conn:
+            conn.executemany(
+                "DELETE FROM infrags WHERE id = ?",
+                [(str(infrag_id),) for infrag_id in infrag_ids],
+            )
+            self.log_changes(conn, [("delete", {"id": infrag_id}, None) for infrag_id in infrag_ids])
+
+    # changes is a list of (op, infrag, vec), written in the caller's transaction
+    def log_changes(self, conn, changes):
+        if not self.change_feed or not changes:
+            return
+        conn.executemany(
+            "INSERT INTO changes (op, id, origin, infrag, vector) VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    op,
+                    str(infrag.get("id")),
+                    self.origin,
+                    json.dumps(infrag, ensure_ascii=False) if op != "delete" else None,
+                    np.asarray(vec, dtype="float32").tobytes() if vec is not None else None,
+                )
+                for op, infrag, vec in changes
+            ],
+        )
+        last = conn.execute("SELECT MAX(seq) FROM changes").fetchone()[0]
+        if last % 1000 < len(changes):
+            conn.execute("DELETE FROM changes WHERE seq <= ?", (last - self.KEEP_CHANGES,))
+
+    def last_change(self):
+        return self.connection().execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    # changes after seq as dicts, and whether some of them were already
+    # pruned (the caller must then reload everything)
+    def changes_since(self, seq, limit=1000):
+        conn = self.connection()
+        first = conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        rows = conn.execute(
+            "SELECT seq, op, id, origin, infrag, vector FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+            (seq, limit),
+        ).fetchall()
+        changes = [
+            {
+                "seq": row[0],
+                "op": row[1],
+                "id": row[2],
+                "origin": row[3],
+                "infrag": json.loads(row[4]) if row[4] else None,
+                "vector": np.frombuffer(row[5], dtype="float32").copy() if row[5] else None,
+            }
+            for row in rows
+        ]
+        return changes, first is not None and first > seq + 1
+
+    # first of n new ids, never handed out twice even across processes
+    def allocate_ids(self, n, floor=0):
+        conn = self.connection()
+        with self.lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM counters WHERE name = 'next_id'").fetchone()
+                if row is None:
+                    row = conn.execute(
+                        "SELECT COALESCE(MAX(CAST(id AS INTEGER)), -1) + 1 FROM infrags WHERE id GLOB '[0-9]*'"
+                    ).fetchone()
+                first = max(row[0], floor)
+                conn.execute(
+                    "INSERT OR REPLACE INTO counters (name, value) VALUES ('next_id', ?)", (first + n,)
+                )
+                conn.commit()
+                return first
+            except Exception:
+                conn.rollback()
+                raise
+
+    def record_vectors(self, items):
+        # items is a list of (infrag_id, text, vec) computed for rows without a vector
+        conn = self.connection()
+        with self.lock, conn:
+            conn.executemany(
+                "UPDATE infrags SET text_hash = ?, vector = ? WHERE id = ? AND text = ?",
+                [
+                    (self.text_hash(text), np.asarray(vec, dtype="float32").tobytes(), str(infrag_id), text)
+                    for infrag_id, text, vec in items
+                ],
+            )
+
+    def needs_compaction(self):
+        return False
+
+    def rotate_log(self):
+        pass
+
+    def write_snapshot(self, infrags, export=True):
+        conn = self.connection()
+        with self.lock, conn:
+            conn.execute("DELETE FROM infrags")
+            self.insert(conn, infrags)
+            # everything changed, the other processes reload
+            self.log_changes(conn, [("reset", {}, None)])
+        if export and self.json_path:
+            self.export_json(infrags)
+
+    # consistent copy of the database (WAL included) in another file
+    def backup(self, path):
+        target = sqlite3.connect(path)
+        try:
+            self.connection().backup(target)
+        finally:
+            target.close()
+
+    def export_json(self, infrags):
+        tmp_path = self.json_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(infrags, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.json_path)
+
+    # the database is always up to date, compacting only exports the JSON file
+    def compact(self, take_snapshot):
+        if not self.compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            infrags = take_snapshot()
+            if self.json_path:
+                self.export_json(infrags)
+            return True
+        finally:
+            self.compaction_lock.release()
@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+
+# This class stores the information fragments as a JSON snapshot
+# (the usual infrags.json) plus an append-only log of mutations.
+# A mutation only appends one line to the log, the snapshot is
+# rewritten from time to time by compaction.
+# Log lines look like:
+#   {"op": "add", "infrag": {...}}
+#   {"op": "update", "infrag": {...}}
+#   {"op": "delete", "id": 12}
+#   {"op": "next_id", "value": 31}
+# the last one starts every new log, so the next id survives a
+# compaction that drops the fragment holding the highest one.
+# Replaying an operation twice gives the same result, so a crash in the
+# middle of a compaction never corrupts the corpus.
+class InfragLogStorage:
+
+    def __init__(self, json_path, log_path=None, compact_every=500):
+        self.json_path = json_path
+        self.log_path = log_path or json_path + ".log"
+        # log being folded into the snapshot by a compaction
+        self.compacting_path = self.log_path + ".compacting"
+        self.compact_every = compact_every
+        self.log_entries = 0
+        # ids are never given twice, even after a delete
+        self.next_free = 0
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+
+    def load(self):
+        infrags = []
+        if os.path.exists(self.json_path):
+            with open(self.json_path, "r", encoding="utf-8") as f:
+                infrags = json.load(f)
+        self.log_entries = 0
+        self.next_free = 0
+        # id -> positions of its records, deleted ones become None until
+        # the end of the replay: each entry costs the same whatever the size
+        positions = {}
+        for pos, infrag in enumerate(infrags):
+            self.seen(infrag.get("id"))
+            positions.setdefault(str(infrag.get("id")), []).append(pos)
+        for path in (self.compacting_path, self.log_path):
+            for entry in self.read_log(path):
+                self.apply(infrags, positions, entry)
+                if entry.get("op") == "next_id":
+                    self.seen(entry["value"] - 1)
+                else:
+                    self.seen(entry.get("id", (entry.get("infrag") or {}).get("id")))
+                    self.log_entries += 1
+        return [infrag for infrag in infrags if infrag is not None]
+
+    def seen(self, infrag_id):
+        if isinstance(infrag_id, str) and infrag_id.isdigit():
+            infrag_id = int(infrag_id)
+        if isinstance(infrag_id, int):
+            self.next_free = max(self.next_free, infrag_id + 1)
+
+    def read_log(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # last line cut by a crash during a write
+                    print(f"Ligne de journal ignorée dans {path}")
+
+    @staticmethod
+    def apply(infrags, positions, entry):
+        op = entry.get("op")
+        if op == "add" or op == "update":
+            infrag = entry["infrag"]
+            key = str(infrag.get("id"))
+            if key in positions:
+                # the first record with this id
+                infrags[positions[key][0]] = infrag
+            else:
+                positions[key] = [len(infrags)]
+                infrags.append(infrag)
+        elif op == "delete":
+            for pos in positions.pop(str(entry["id"]), []):
+                infrags[pos] = None
+
+    def append(self, entries):
+        with self.lock:
+            self.write_log(entries)
+            self.log_entries += len(entries)
+
+    def write_log(self, entries):
+        # called with self.lock held
+        lines = "".join(
+            json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries
+        )
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # vectors live in the VectorCache file for this storage
+    def load_vectors(self):
+        return {}
+
+    def record_vectors(self, items):
+        pass
+
+    def record_add(self, infrag, vec=None):
+        self.record_add_many([infrag])
+
+    # one write and one fsync for the whole batch
+    def record_add_many(self, infrags, vectors=None):
+        self.append([{"op": "add", "infrag": infrag} for infrag in infrags])
+
+    def record_update(self, infrag, vec=None):
+        self.append([{"op": "update", "infrag": infrag}])
+
+    def record_delete(self, infrag_ids):
+        self.append([{"op": "delete", "id": infrag_id} for infrag_id in infrag_ids])
+
+    # first of n new ids, never below floor; a single process writes this storage
+    def allocate_ids(self, n, floor=0):
+        with self.lock:
+            first = max(self.next_free, floor)
+            self.next_free = first + n
+            return first
+
+    def needs_compaction(self):
+        return self.log_entries >= self.compact_every
+
+    def rotate_log(self):
+        """Met de côté le journal courant, les écritures suivantes vont dans un nouveau journal"""
+        with self.lock:
+            if os.path.exists(self.log_path):
+                if os.path.exists(self.compacting_path):
+                    with open(self.log_path, "r", encoding="utf-8") as src:
+                        with open(self.compacting_path, "a", encoding="utf-8") as dst:
+                            dst.write(src.read())
+                    os.remove(self.log_path)
+                else:
+                    os.replace(self.log_path, self.compacting_path)
+            self.write_log([{"op": "next_id", "value": self.next_free}])
+            self.log_entries = 0
+
+    def write_snapshot(self, infrags):
+        tmp_path = self.json_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(infrags, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.json_path)
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+
+    # take_snapshot() is called while the writers are blocked, it must
+    # call rotate_log() and return a copy of the fragments
+    def compact(self, take_snapshot):
+        if not self.compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            self.write_snapshot(take_snapshot())
+            return True
+        finally:
+            self.compaction_lock.release()
@@ -1,9 +1,28 @@
 from datetime import datetime
-import json
-import faiss
+import bisect
+import itertools
 import os
+import socket
+import tempfile
+import threading
+import faiss
 import numpy as np
-from infrags_mgr.embedder import Embedder
+from infrags_mgr.ann_index import AnnConfig
+from infrags_mgr.embedder import get_embedder
+from infrags_mgr.infrag_storage import InfragLogStorage
+from infrags_mgr.infrag_sqlite import InfragSqliteStorage
+from infrags_mgr.keyword_index import reciprocal_rank_fusion, tokenize
+from infrags_mgr.index_file import (
+    corpus_fingerprint,
+    load_index,
+    load_index_rows,
+    load_shared_vectors,
+    save_index,
+    save_shared_vectors,
+)
+from infrags_mgr.tiered_storage import TieredSync
+from infrags_mgr.vector_cache import VectorCache
+from infrags_mgr.vector_partition import VectorPartition
 from google.cloud import storage
 
 def get_is_local():
@@ -15,132 +34,738 @@ def get_is_local():
 
 class InfragStore:
 
+    # fields that change the saved index when they change
+    FINGERPRINT_FIELDS = ("id", "user_id", "user_context", "text")
+    SEARCH_MODES = ("vector", "keyword", "hybrid")
+
     def __init__(
         self,
         json_path="infrags_mgr/data/infrags.json",
         index_path="infrags_mgr/data/infrags.faiss",
+        vectors_path="infrags_mgr/data/infrags.vectors",
+        backend="log", # "log" or "sqlite"
+        sqlite_path="infrags_mgr/data/infrags.db",
         gcs_bucket_name=None, #"voice-agent-infrags",
         gcs_blob_path="infrags.json",
+        # several processes (uvicorn --workers) share the sqlite storage
+        shared=False,
+        # sqlite_path is on a disk that survives a restart (a mounted
+        # volume); without it or a bucket, the sqlite backend is refused on
+        # Cloud Run
+        sqlite_durable=False,
+        shared_dir=os.path.join(tempfile.gettempdir(), "infrags_shared"),
+        # with a bucket (gcs_bucket_name, or any object with the same
+        # blob methods such as tiered_storage.LocalBucket) the files live
+        # in local_dir and are written back to the bucket in the background
+        bucket=None,
+        local_dir=os.path.join(tempfile.gettempdir(), "infrags_local"),
+        flush_debounce=2.0,
+        # index of every partition (AnnConfig), index_configs overrides it
+        # for some (user_id, user_context) pairs
+        index_config=None,
+        index_configs=None,
+        # "vector", "keyword" (BM25) or "hybrid" (both, fused); in hybrid
+        # mode a query of at most keyword_only_terms words that are all in
+        # the tenant's fragments is served by the keyword search alone
+        search_mode="hybrid",
+        keyword_only_terms=2,
+        search_k=10,
     ):
-        if (get_is_local() == False):
+        self.tiered = None
+        if gcs_bucket_name and bucket is None:
+            bucket = storage.Client().bucket(gcs_bucket_name)
+        if bucket is not None:
+            json_path = os.path.join(local_dir, "infrags.json")
+            index_path = os.path.join(local_dir, "infrags.faiss")
+            vectors_path = os.path.join(local_dir, "infrags.vectors")
+            sqlite_path = os.path.join(local_dir, "infrags.db")
+            prefix = os.path.dirname(gcs_blob_path)
+            self.tiered = TieredSync(
+                bucket, local_dir, prefix=prefix + "/" if prefix else "", debounce=flush_debounce
+            )
+            if backend == "sqlite":
+                # the WAL is folded into the copy sent to the bucket
+                self.tiered.track("infrags.db", prepare=lambda path: self.storage.backup(path))
+                self.tiered.track("infrags.json")
+            else:
+                # snapshot first: replaying an older log over a newer snapshot
+                # gives the same fragments, the other way round loses writes.
+                # The vectors file is a cache appended to on every write, it
+                # stays local: a start reuses the rows of the saved index
+                for name in ("infrags.json", "infrags.json.log.compacting", "infrags.json.log"):
+                    self.tiered.track(name)
+            for name in ("infrags.faiss", "infrags.faiss.meta.json"):
+                self.tiered.track(name)
+            self.tiered.pull()
+        elif (get_is_local() == False):
             json_path = "/gcs/voiceagent/infrags.json"
+            index_path = "/gcs/voiceagent/infrags.faiss"
+            # the vectors file is a cache appended to and rewritten on
+            # compaction, it stays on local disk; after a restart the
+            # vectors come from the saved index
+            vectors_path = os.path.join(local_dir, "infrags.vectors")
         self.json_path = json_path
         self.index_path = index_path
-        self.embedder = Embedder()
+        self.embedder = get_embedder()
         self.dim = 384
+        self.backend = backend
+        if shared and backend != "sqlite":
+            raise ValueError("shared=True needs the sqlite backend")
+        if backend == "sqlite" and bucket is None and not sqlite_durable and not get_is_local():
+            # the container disk is lost on restart and the database would be
+            # imported again from the JSON on /gcs, only exported on reload
+            raise ValueError("the sqlite backend needs a bucket or a durable sqlite_path (sqlite_durable=True)")
+        # in shared mode each process applies the others' writes from the
+        # storage change feed and maps the vectors from shared_dir
+        self.shared = shared
+        self.shared_dir = shared_dir if shared else None
+        self.origin = f"{socket.gethostname()}:{os.getpid()}"
+        self.index_config = index_config or AnnConfig()
+        self.index_configs = dict(index_configs or {})
+        if search_mode not in self.SEARCH_MODES:
+            raise ValueError(f"unknown search mode {search_mode!r}, expected one of {self.SEARCH_MODES}")
+        self.search_mode = search_mode
+        self.keyword_only_terms = keyword_only_terms
+        self.search_k = search_k
+        self.searches = {"vector": 0, "keyword": 0, "hybrid": 0}
+        # quantized partitions re-rank from float32 vectors kept on disk
+        # (vectors file or database) rather than in memory
+        quantized = any(c.quantizer for c in (self.index_config, *self.index_configs.values()))
+        if backend == "sqlite":
+            # vectors are stored in the database next to the text
+            self.storage = InfragSqliteStorage(
+                sqlite_path, json_path, self.dim, change_feed=shared, origin=self.origin
+            )
+            self.vector_cache = VectorCache(
+                None, self.dim, resident=not quantized, loader=self.storage.stored_vectors if quantized else None
+            )
+        else:
+            self.storage = InfragLogStorage(json_path)
+            self.vector_cache = VectorCache(vectors_path, self.dim, resident=not quantized)
         # os.makedirs("data", exist_ok=True)
+        self.lock = threading.RLock()
+        # callables notified as fn(event, infrag) on "add", "update", "delete"
+        self.listeners = []
+        # records sorted by id for paging, per filter, kept up to date by
+        # the writes and dropped with the generation
+        self.orders = {}
+        # last change of the feed reflected in memory, read before the
+        # records: changes applied twice give the same result
+        self.last_change = self.storage.last_change() if shared else 0
         self.infrags = self.load_infrags()
-        self.index = faiss.IndexFlatL2(self.dim)
-        self.id_map = []
+        stored_vectors = self.storage.load_vectors() if self.vector_cache.resident else None
+        if stored_vectors:
+            self.vector_cache.preload(stored_vectors)
+        # one vector partition per (user_id, user_context)
+        self.partitions = {}
+        # records + partitions are replaced together by a reload, each
+        # replacement is a new generation; writes are counted so a
+        # build can tell that it missed some
+        self.generation = 0
+        self.mutations = 0
+        self.build_lock = threading.Lock()
+        self.vector_compaction_lock = threading.Lock()
+        self.build = {"state": "idle"}
         if self.infrags:
             self.rebuild_index()
+        self.generation = 1
         self.gcs_bucket_name = gcs_bucket_name
         self.gcs_blob_path = gcs_blob_path
-        if gcs_bucket_name:
-            self.gcs_client = storage.Client()
-            self.gcs_bucket = self.gcs_client.bucket(gcs_bucket_name)
 
     def load_infrags(self):
-        if os.path.exists(self.json_path):
-            with open(self.json_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        return []
+        # snapshot + replay of the mutation log
+        return self.storage.load()
+
+    def take_snapshot(self):
+        with self.lock:
+            self.storage.rotate_log()
+            return [dict(infrag) for infrag in self.infrags]
 
     def save_infrags(self):
-        with open(self.json_path, "w", encoding="utf-8") as f:
-            json.dump(self.infrags, f, ensure_ascii=False, indent=2)
+        # full rewrite of the snapshot, mutations only append to the log
+        if self.storage.compact(self.take_snapshot):
+            self.save_index()
+
+    def write_index(self, infrags, vectors):
+        index = faiss.IndexFlatL2(self.dim)
+        if len(vectors):
+            index.add(np.array(vectors).astype("float32"))
+        keys = [VectorCache.make_key(i["id"], i["text"]) for i in infrags]
+        save_index(index, self.index_path, corpus_fingerprint(infrags, self.FINGERPRINT_FIELDS), keys)
+
+    def save_index(self):
+        # all vectors in self.infrags order, read back from the partitions
+        with self.lock:
+            infrags = list(self.infrags)
+            vectors = [None] * len(infrags)
+            for key, positions in self.group_positions(infrags).items():
+                found = self.partitions[key].vectors([infrags[pos] for pos in positions])
+                for pos, vec in zip(positions, found):
+                    vectors[pos] = vec
+        try:
+            self.write_index(infrags, vectors)
+        except Exception as e:
+            print(f"Erreur lors de la sauvegarde de l'index: {e}")
+        self.changed()
+
+    def compact_in_background(self):
+        if self.storage.needs_compaction():
+            threading.Thread(target=self.save_infrags, daemon=True).start()
+        if self.vector_cache.needs_compaction() and self.vector_compaction_lock.acquire(blocking=False):
+            threading.Thread(target=self.compact_vectors, daemon=True).start()
+
+    def compact_vectors(self):
+        # updates and deletes leave dead records in the append-only vectors
+        # file, the live keys are rewritten without the store lock
+        try:
+            self.vector_cache.compact()
+        except Exception as e:
+            print(f"Erreur lors du compactage des vecteurs: {e}")
+        finally:
+            self.vector_compaction_lock.release()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def changed(self):
+        if self.tiered is not None:
+            self.tiered.mark_dirty()
+
+    # writes are refused (StorageConflict) once the bucket was changed by
+    # another writer, they could no longer be written back
+    def check_writable(self):
+        if self.tiered is not None:
+            self.tiered.check_writable()
+
+    # returns True once every file is in the bucket (or without a bucket)
+    def flush(self):
+        if self.tiered is None:
+            return True
+        return self.tiered.barrier()
+
+    def notify(self, event, infrag):
+        self.changed()
+        for listener in self.listeners:
+            try:
+                listener(event, infrag)
+            except Exception as e:
+                print(f"Erreur dans un listener ({event}): {e}")
+
+    def get_vector(self, infrag):
+        # reuse the cached embedding unless the text has changed
+        vec = self.vector_cache.get(infrag["id"], infrag["text"])
+        if vec is None:
+            vec = self.embedder.embed(infrag["text"])
+            self.vector_cache.put(infrag["id"], infrag["text"], vec)
+        return vec
+
+    def get_vectors(self, infrags, progress=None, batch_size=256):
+        # same as get_vector for a list, missing texts are embedded in batches,
+        # progress (a dict) gets "to_embed" and "embedded" counts
+        vectors = self.vector_cache.get_many([(i["id"], i["text"]) for i in infrags])
+        missing = [pos for pos, vec in enumerate(vectors) if vec is None]
+        if progress is not None:
+            progress["to_embed"] = len(missing)
+            progress["embedded"] = 0
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            embedded = self.embedder.embed_many([infrags[pos]["text"] for pos in batch])
+            for pos, vec in zip(batch, embedded):
+                vectors[pos] = vec
+            items = [(infrags[pos]["id"], infrags[pos]["text"], vectors[pos]) for pos in batch]
+            self.vector_cache.put_many(items)
+            self.storage.record_vectors(items)
+            if progress is not None:
+                progress["embedded"] += len(batch)
+        return vectors
+
+    def next_id(self):
+        # floor of the storage's id counter (which never gives an id
+        # twice): new ids stay above the records in memory, e.g. an upload
+        ids = [i["id"] for i in self.infrags if isinstance(i.get("id"), int)]
+        return max(ids, default=-1) + 1
+
+    def get_partition(self, user_id, user_context):
+        key = (user_id, user_context)
+        partition = self.partitions.get(key)
+        if partition is None:
+            partition = VectorPartition(self.dim, self.config_for(key), self.exact_vectors)
+            self.partitions[key] = partition
+        return partition
+
+    # float32 vectors of quantized partitions, read for re-ranking
+    def exact_vectors(self, infrags):
+        return self.vector_cache.get_many([(i["id"], i["text"]) for i in infrags])
+
+    def config_for(self, key):
+        return self.index_configs.get(key, self.index_config)
+
+    # changes the index of one partition, kept for the next generations
+    def set_index_config(self, user_id, user_context, config):
+        key = (user_id, user_context)
+        with self.lock:
+            self.index_configs[key] = config
+            partition = self.partitions.get(key)
+            if partition is not None:
+                partition.set_config(config)
+
+    def index_status(self):
+        with self.lock:
+            kinds = {}
+            vectors = resident = mapped = quantized = 0
+            for partition in self.partitions.values():
+                kind = partition.index_kind()
+                kinds[kind] = kinds.get(kind, 0) + 1
+                memory = partition.memory()
+                vectors += memory["vectors"]
+                resident += memory["bytes"]
+                mapped += memory["mapped_bytes"]
+                quantized += partition.quantized
+            resident += self.vector_cache.memory_bytes()
+            return {
+                "default": self.index_config.to_dict(),
+                "overrides": len(self.index_configs),
+                "partitions": kinds,
+                "quantized_partitions": quantized,
+                "largest": max((len(p) for p in self.partitions.values()), default=0),
+                "vectors": vectors,
+                # estimates: indexes + vector cache, and the shared mapped file
+                "resident_bytes": resident,
+                "mapped_bytes": mapped,
+                "bytes_per_vector": round(resident / vectors) if vectors else None,
+                "search_mode": self.search_mode,
+                "searches": dict(self.searches),
+                "keyword_terms": sum(len(p.keywords.postings) for p in self.partitions.values()),
+            }
 
     def add_infrag(self, user_id, user_context, text, date):
+        self.check_writable()
         vec = self.embedder.embed(text)
-        infrag_id = len(self.infrags)
-        json_data = {
-            "id": infrag_id,
-            "user_id": user_id,
-            "user_context": user_context,
-            "text": text,
-            "storage_date": date,
+        with self.lock:
+            infrag_id = self.storage.allocate_ids(1, self.next_id())
+            self.vector_cache.put(infrag_id, text, vec)
+            json_data = {
+                "id": infrag_id,
+                "user_id": user_id,
+                "user_context": user_context,
+                "text": text,
+                "storage_date": date,
+            }
+            self.infrags.append(json_data)
+            self.mutations += 1
+            self.order_add(json_data)
+            self.get_partition(user_id, user_context).add(json_data, vec)
+            self.storage.record_add(json_data, vec)
+            self.notify("add", json_data)
+        self.compact_in_background()
+
+    # Adds many fragments at once: one embed_many call, one partition
+    # update per tenant and one durable write for the whole batch.
+    # items are dicts with user_id, user_context, text and optionally
+    # storage_date. Returns the new ids in items order. Does not
+    # compact, callers call compact_in_background() once they are done.
+    def add_infrags(self, items, date):
+        if not items:
+            return []
+        self.check_writable()
+        vectors = self.embedder.embed_many([item["text"] for item in items])
+        with self.lock:
+            first_id = self.storage.allocate_ids(len(items), self.next_id())
+            added = []
+            grouped = {}
+            for offset, (item, vec) in enumerate(zip(items, vectors)):
+                json_data = {
+                    "id": first_id + offset,
+                    "user_id": item["user_id"],
+                    "user_context": item["user_context"],
+                    "text": item["text"],
+                    "storage_date": item.get("storage_date") or date,
+                }
+                added.append(json_data)
+                group = grouped.setdefault((json_data["user_id"], json_data["user_context"]), ([], []))
+                group[0].append(json_data)
+                group[1].append(vec)
+            self.infrags.extend(added)
+            self.mutations += 1
+            for json_data in added:
+                self.order_add(json_data)
+            self.vector_cache.put_many([(i["id"], i["text"], vec) for i, vec in zip(added, vectors)])
+            for (user_id, user_context), (infrags, group_vectors) in grouped.items():
+                self.get_partition(user_id, user_context).add_many(infrags, group_vectors)
+            self.storage.record_add_many(added, vectors)
+            for json_data in added:
+                self.notify("add", json_data)
+            return [json_data["id"] for json_data in added]
+
+    # vectors of infrags in order and whether they were computed (True)
+    # rather than read from the saved index (False)
+    def vectors_for(self, infrags, progress=None):
+        fingerprint = corpus_fingerprint(infrags, self.FINGERPRINT_FIELDS)
+        index = load_index(self.index_path, fingerprint)
+        if index is not None:
+            # same corpus as the saved index, nothing to embed
+            return index.reconstruct_n(0, index.ntotal), False
+        # another corpus (writes since the index was saved): the rows of
+        # records with the same id and text are reused, only the others
+        # go through the cache and the embedder
+        index, keys = load_index_rows(self.index_path)
+        if index is None or not index.ntotal:
+            return self.get_vectors(infrags, progress), True
+        rows = {key: row for row, key in enumerate(keys)}
+        saved = index.reconstruct_n(0, index.ntotal)
+        vectors = [None] * len(infrags)
+        missing = []
+        for pos, infrag in enumerate(infrags):
+            row = rows.get(VectorCache.make_key(infrag["id"], infrag["text"]))
+            if row is None:
+                missing.append(pos)
+            else:
+                vectors[pos] = saved[row]
+        for pos, vec in zip(missing, self.get_vectors([infrags[pos] for pos in missing], progress)):
+            vectors[pos] = vec
+        return vectors, True
+
+    def make_partitions(self, infrags, vectors):
+        grouped = {}
+        for mem, vec in zip(infrags, vectors):
+            group = grouped.setdefault((mem.get("user_id"), mem.get("user_context")), ([], []))
+            group[0].append(mem)
+            group[1].append(vec)
+        partitions = {}
+        for key, (group_infrags, group_vectors) in grouped.items():
+            partition = VectorPartition(self.dim, self.config_for(key), self.exact_vectors)
+            partition.add_many(group_infrags, group_vectors)
+            partitions[key] = partition
+        return partitions
+
+    # partitions for infrags, and whether their vectors had to be computed;
+    # in shared mode the vectors are mapped from the file of this corpus
+    # when another process already wrote it
+    def load_generation(self, infrags, progress=None):
+        if self.shared_dir:
+            fingerprint = corpus_fingerprint(infrags, self.FINGERPRINT_FIELDS)
+            shared = load_shared_vectors(self.shared_dir, fingerprint, self.dim)
+            if shared is not None and len(shared) == len(infrags):
+                return self.shared_partitions(infrags, shared), False
+        vectors, computed = self.vectors_for(infrags, progress)
+        return self.partitions_for(infrags, vectors), computed
+
+    def partitions_for(self, infrags, vectors):
+        if not self.shared_dir:
+            return self.make_partitions(infrags, vectors)
+        # written grouped by partition so that each one maps a contiguous slice
+        order = [pos for positions in self.group_positions(infrags).values() for pos in positions]
+        vectors = np.asarray(vectors, dtype="float32").reshape(-1, self.dim)
+        fingerprint = corpus_fingerprint(infrags, self.FINGERPRINT_FIELDS)
+        shared = save_shared_vectors(self.shared_dir, fingerprint, vectors[order])
+        return self.shared_partitions(infrags, shared)
+
+    @staticmethod
+    def group_positions(infrags):
+        grouped = {}
+        for pos, mem in enumerate(infrags):
+            grouped.setdefault((mem.get("user_id"), mem.get("user_context")), []).append(pos)
+        return grouped
+
+    def shared_partitions(self, infrags, shared):
+        partitions = {}
+        start = 0
+        for key, positions in self.group_positions(infrags).items():
+            partitions[key] = VectorPartition.from_base(
+                [infrags[pos] for pos in positions],
+                shared[start:start + len(positions)],
+                self.dim,
+                self.config_for(key),
+                self.exact_vectors,
+            )
+            start += len(positions)
+        return partitions
+
+    def drop_stale_vectors(self, infrags):
+        live_keys = {
+            VectorCache.make_key(mem["id"], mem["text"]) for mem in infrags
         }
-        self.infrags.append(json_data)
-        self.index.add(np.array([vec]).astype("float32"))
-        self.id_map.append(infrag_id)
-        self.save_infrags()
+        if len(live_keys) < len(self.vector_cache.vectors) or self.vector_cache.needs_compaction():
+            self.vector_cache.compact(live_keys)
 
     def rebuild_index(self):
-        vectors = []
-        self.id_map = []
-        for i, mem in enumerate(self.infrags):
-            vec = self.embedder.embed(mem["text"])
-            vectors.append(vec)
-            self.id_map.append(mem["id"])
-        self.index.add(np.array(vectors).astype("float32"))
-
-    def search_infrags(self, user_id, user_context, query, language, k=15):
-        filtered_infrags = [
-            infrag
-            for infrag in self.infrags
-            if infrag["user_id"] == user_id
-            and infrag["user_context"] == user_context
-        ]
-        if not filtered_infrags:
-            return []
-        temp_index = faiss.IndexFlatL2(self.dim)
-        temp_id_map = []
-        vectors = []
-        for i, infrag in enumerate(filtered_infrags):
-            vec = self.embedder.embed(infrag["text"])
-            vectors.append(vec)
-            temp_id_map.append(i)
-        temp_index.add(np.array(vectors).astype("float32"))
-        vec = self.embedder.embed(query)
-        D, I = temp_index.search(np.array([vec]).astype("float32"), 10)
-        print(I)
-        data = [filtered_infrags[temp_id_map[i]] for i in I[0]]
-        print(data)
+        self.partitions, computed = self.load_generation(self.infrags)
+        if computed:
+            self.drop_stale_vectors(self.infrags)
+            self.save_index()
+
+    def search_infrags(self, user_id, user_context, query, language, k=15, mode=None):
+        infrags, vec, version = self.search_infrags_with_vector(user_id, user_context, query, language, k, mode)
+        return infrags
+
+    # same as search_infrags, also returns the query vector (None when the
+    # query was not embedded) and the version of the tenant's partition
+    # so callers can reuse them
+    def search_infrags_with_vector(self, user_id, user_context, query, language, k=15, mode=None):
+        self.sync()
+        partition = self.partitions.get((user_id, user_context))
+        if partition is None or len(partition) == 0:
+            return [], None, None
+        mode = mode or self.search_mode
+        if mode not in self.SEARCH_MODES:
+            raise ValueError(f"unknown search mode {mode!r}, expected one of {self.SEARCH_MODES}")
+        terms = tokenize(query) if mode != "vector" else []
+        keyword_only = mode == "keyword" or (
+            mode == "hybrid"
+            and 0 < len(terms) <= self.keyword_only_terms
+            and partition.keywords.covers(terms)
+        )
+        data = None
+        vec = None
+        if keyword_only:
+            with self.lock:
+                data = partition.keywords.search(terms, self.search_k)
+                version = partition.version
+            # no keyword hit, the embedding is still needed
+            mode = "keyword" if data else "hybrid"
+        if not data:
+            vec = self.embedder.embed_query(query)
+            with self.lock:
+                if terms:
+                    # deeper lists than returned, fusion promotes fragments found by both
+                    data = reciprocal_rank_fusion(
+                        [partition.search(vec, 2 * self.search_k), partition.keywords.search(terms, 2 * self.search_k)],
+                        self.search_k,
+                    )
+                else:
+                    data = partition.search(vec, self.search_k)
+                version = partition.version
+        self.searches[mode if terms else "vector"] += 1
         unique = {item["id"]: item for item in data}.values()
-        print(list(unique))
-        #return data
-        return list(unique)
+        print([item["id"] for item in unique])
+        return list(unique), vec, version
 
-    def reload_infrags(self):
-        self.infrags = self.load_infrags()
-        self.index.reset()  # Clear the existing FAISS index
-        if self.infrags:
-            self.rebuild_index()
+    # Builds a new generation (records + partitions) on a background
+    # thread while the current one keeps serving, then swaps them under
+    # the lock. With infrags=None the records are read back from the
+    # storage, otherwise the given records replace the stored ones
+    # (upload). Only texts without a cached vector are embedded.
+    # Returns False when a build is already running.
+    def reload_infrags(self, infrags=None, wait=False):
+        if infrags is not None:
+            self.check_writable()
+        if not self.build_lock.acquire(blocking=False):
+            return False
+        self.build = {
+            "state": "building",
+            "generation": self.generation + 1,
+            "source": "storage" if infrags is None else "upload",
+            "started": datetime.now().strftime("%Y-%m-%d@%H-%M-%S"),
+            "attempt": 0,
+            "total": 0,
+            "to_embed": 0,
+            "embedded": 0,
+        }
+        thread = threading.Thread(target=self.build_generation, args=(infrags,), daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return True
 
-    def update_infrag(self, infrag_id: str, user_id: str, user_context: str, new_text: str) -> bool:
+    def read_storage(self):
+        # not in the middle of a compaction, whose files come and go
+        with self.storage.compaction_lock:
+            return self.storage.load()
+
+    def build_generation(self, infrags=None, attempts=3):
+        start = datetime.now()
         try:
-            # Lire le fichier actuel
-            file_path = "infrags_mgr/data/infrags.json"
-            if not self.get_is_local():
-                file_path = "/gcs/voiceagent/infrags.json"
-
-            with open(file_path, "r") as file:
-                infrags = json.load(file)
-
-            # Chercher le fragment à modifier
-            for infrag in infrags:
-                # print(f"id: {infrag.get('id')}")
-                # print(f"infrag_id: {infrag_id}")
-                if (
-                    str(infrag.get('id')) == infrag_id
-                    or
-                    (
-                        infrag.get('user_id') == user_id
-                        and
-                        infrag.get('user_context') == user_context
-                        and
-                        infrag.get('id', f"{user_id}_{user_context}_{infrag.get('storage_date', '')}") == infrag_id
-                    )
-                ):
+            for attempt in range(1, attempts + 1):
+                self.build["attempt"] = attempt
+                if infrags is not None:
+                    self.build["total"] = len(infrags)
+                    vectors, computed = self.vectors_for(infrags, self.build)
+                    partitions = self.partitions_for(infrags, vectors)
+                    with self.storage.compaction_lock, self.lock:
+                        self.storage.rotate_log()
+                        self.storage.write_snapshot(infrags)
+                        self.storage.record_vectors(
+                            [(i["id"], i["text"], vec) for i, vec in zip(infrags, vectors)]
+                        )
+                        self.swap(infrags, partitions)
+                    break
+                if attempt == attempts:
+                    # writes kept coming, build this one with the writers
+                    # blocked, their vectors are cached by now
+                    with self.storage.compaction_lock, self.lock:
+                        last_change = self.storage.last_change() if self.shared else 0
+                        records = self.storage.load()
+                        self.build["total"] = len(records)
+                        partitions, computed = self.load_generation(records, self.build)
+                        self.swap(records, partitions, last_change)
+                    break
+                with self.lock:
+                    # writers hold the lock until their durable write is
+                    # done, every write counted here is in the storage
+                    mutations = self.mutations
+                    last_change = self.storage.last_change() if self.shared else 0
+                records = self.read_storage()
+                self.build["total"] = len(records)
+                partitions, computed = self.load_generation(records, self.build)
+                with self.lock:
+                    # a write during the build is not in these records
+                    if self.mutations == mutations:
+                        self.swap(records, partitions, last_change)
+                        break
+            if computed:
+                with self.lock:
+                    self.drop_stale_vectors(self.infrags)
+                self.save_index()
+            self.build["state"] = "done"
+        except Exception as e:
+            print(f"Erreur lors de la reconstruction des fragments: {e}")
+            self.build["state"] = "failed"
+            self.build["error"] = str(e)
+        finally:
+            self.build["seconds"] = round((datetime.now() - start).total_seconds(), 3)
+            self.build_lock.release()
+
+    def swap(self, infrags, partitions, last_change=None):
+        # called with self.lock held
+        self.infrags = infrags
+        self.partitions = partitions
+        self.orders = {}
+        if last_change is not None:
+            self.last_change = last_change
+        self.generation += 1
+        self.build["generation"] = self.generation
+        self.changed()
+
+    # Applies the writes of the other processes found in the change feed
+    # since the last call. Called before reads, a no-op unless shared.
+    def sync(self):
+        if not self.shared or self.storage.last_change() == self.last_change:
+            return
+        while True:
+            changes, pruned = self.storage.changes_since(self.last_change)
+            if pruned:
+                # too far behind, the feed no longer has everything
+                self.reload_infrags()
+                return
+            if not changes:
+                return
+            # fragments written without their vector are embedded before
+            # taking the lock, searches are not blocked meanwhile
+            missing = [
+                change for change in changes
+                if change["op"] in ("add", "update") and change["vector"] is None and change["origin"] != self.origin
+            ]
+            if missing:
+                vectors = self.embedder.embed_many([change["infrag"]["text"] for change in missing])
+                for change, vec in zip(missing, vectors):
+                    change["vector"] = vec
+            with self.lock:
+                for change in changes:
+                    if change["seq"] <= self.last_change:
+                        # applied by a concurrent sync
+                        continue
+                    if change["origin"] != self.origin:
+                        self.apply_change(change)
+                    self.last_change = change["seq"]
 
-                    infrag['text'] = new_text
-                    infrag['modified_date'] = datetime.now().strftime("%Y-%m-%d")
+    # called with self.lock held, "add" and "update" changes have their vector
+    def apply_change(self, change):
+        op = change["op"]
+        if op == "reset":
+            self.reload_infrags()
+            return
+        self.mutations += 1
+        if op == "delete":
+            deleted = [i for i in self.infrags if str(i.get("id")) == change["id"]]
+            if deleted:
+                self.infrags = [i for i in self.infrags if str(i.get("id")) != change["id"]]
+            for infrag in deleted:
+                self.order_remove(infrag)
+                self.vector_cache.invalidate(infrag.get("id"))
+                partition = self.partitions.get((infrag.get("user_id"), infrag.get("user_context")))
+                if partition is not None:
+                    partition.remove(infrag)
+                self.notify("delete", infrag)
+            return
+        # "add" and "update" both replace the fragment with this id
+        data = change["infrag"]
+        vec = change["vector"]
+        partition = self.get_partition(data.get("user_id"), data.get("user_context"))
+        existing = next(
+            (i for i in partition.infrags.values() if str(i.get("id")) == change["id"]), None
+        )
+        self.vector_cache.put(data["id"], data["text"], vec)
+        if existing is not None:
+            existing.clear()
+            existing.update(data)
+            partition.update(existing, vec)
+            self.notify("update", existing)
+        else:
+            self.infrags.append(data)
+            self.order_add(data)
+            partition.add(data, vec)
+            self.notify("add", data)
 
-                    # Sauvegarder
-                    with open(file_path, "w") as file:
-                        json.dump(infrags, file, indent=2, ensure_ascii=False)
+    def generation_status(self):
+        with self.lock:
+            return {
+                "generation": self.generation,
+                "records": len(self.infrags),
+                "build": dict(self.build),
+            }
+
+    def check_consistency(self):
+        # the vector count must always equal the record count
+        with self.lock:
+            indexed = sum(p.vector_count() for p in self.partitions.values())
+            broken = [
+                f"{user_id}/{user_context}"
+                for (user_id, user_context), p in self.partitions.items()
+                if not p.is_consistent()
+            ]
+            return {
+                "records": len(self.infrags),
+                "vectors": indexed,
+                "consistent": indexed == len(self.infrags) and not broken,
+                "broken_partitions": broken,
+            }
+
+    def matches(self, infrag, infrag_id, user_id, user_context):
+        return (
+            str(infrag.get('id')) == infrag_id
+            or
+            (
+                infrag.get('user_id') == user_id
+                and
+                infrag.get('user_context') == user_context
+                and
+                infrag.get('id', f"{user_id}_{user_context}_{infrag.get('storage_date', '')}") == infrag_id
+            )
+        )
+
+    def update_infrag(self, infrag_id: str, user_id: str, user_context: str, new_text: str) -> bool:
+        self.check_writable()
+        try:
+            self.sync()
+            # the old vector is stale, embed the new text once, before
+            # taking the lock
+            vec = self.embedder.embed(new_text)
+            with self.lock:
+                # Chercher le fragment à modifier
+                for infrag in self.infrags:
+                    if self.matches(infrag, infrag_id, user_id, user_context):
+                        infrag['text'] = new_text
+                        infrag['modified_date'] = datetime.now().strftime("%Y-%m-%d")
+                        self.mutations += 1
+                        self.vector_cache.invalidate(infrag['id'])
+                        self.vector_cache.put(infrag['id'], new_text, vec)
+                        self.get_partition(infrag.get('user_id'), infrag.get('user_context')).update(infrag, vec)
 
-                    return True
+                        # Sauvegarder
+                        self.storage.record_update(infrag, vec)
+                        self.notify("update", infrag)
+                        self.compact_in_background()
+                        return True
 
             print("Fragment non trouvé")
             return False
@@ -150,68 +775,139 @@ class InfragStore:
             return False
 
     def delete_infrag(self, infrag_id: str, user_id: str, user_context: str) -> bool:
+        self.check_writable()
         try:
-            # Lire le fichier actuel
-            file_path = "infrags_mgr/data/infrags.json"
-            if not self.get_is_local():
-                file_path = "/gcs/voiceagent/infrags.json"
-
-            with open(file_path, "r") as file:
-                infrags = json.load(file)
-            #print(f"Nombre de fragments avant suppression: {len(infrags)}")
-            # Chercher et supprimer le fragment
-            original_length = len(infrags)
-            infrags = [infrag for infrag in infrags if not (
-                str(infrag.get('id')) == infrag_id
-                or
-                (
-                    infrag.get('user_id') == user_id
-                    and
-                    infrag.get('user_context') == user_context
-                    and
-                    infrag.get('id', f"{user_id}_{user_context}_{infrag.get('storage_date', '')}") == infrag_id
-                )
-            )]
-            #print(f"Nombre de fragments après suppression: {len(infrags)}")
-
-            if len(infrags) < original_length:
+            self.sync()
+            with self.lock:
+                # Chercher et supprimer le fragment
+                deleted = [
+                    infrag for infrag in self.infrags
+                    if self.matches(infrag, infrag_id, user_id, user_context)
+                ]
+                if not deleted:
+                    return False
+                self.infrags = [
+                    infrag for infrag in self.infrags
+                    if not self.matches(infrag, infrag_id, user_id, user_context)
+                ]
+                self.mutations += 1
+                for infrag in deleted:
+                    self.order_remove(infrag)
+                    self.vector_cache.invalidate(infrag.get('id'))
+                    partition = self.partitions.get((infrag.get('user_id'), infrag.get('user_context')))
+                    if partition is not None:
+                        partition.remove(infrag)
                 # Sauvegarder
-                with open(file_path, "w") as file:
-                    json.dump(infrags, file, indent=2, ensure_ascii=False)
+                self.storage.record_delete([infrag.get('id') for infrag in deleted])
+                for infrag in deleted:
+                    self.notify("delete", infrag)
+                self.compact_in_background()
                 return True
 
-            return False
-
         except Exception as e:
             print(f"Erreur lors de la suppression du fragment: {e}")
             return False
 
-    def get_infrags_filtered(self, user_id: str = None, user_context: str = None) -> list:
-        try:
-            file_path = "infrags_mgr/data/infrags.json"
-            if not self.get_is_local():
-                file_path = "/gcs/voiceagent/infrags.json"
+    # ints in numeric order first, then the other ids as strings; "12"
+    # and 12 are the same position
+    @staticmethod
+    def id_key(infrag_id):
+        if isinstance(infrag_id, int) or (isinstance(infrag_id, str) and infrag_id.isdigit()):
+            return (0, int(infrag_id), "")
+        return (1, 0, str(infrag_id))
 
-            with open(file_path, "r") as file:
-                infrags = json.load(file)
+    def order_key(self, infrag):
+        return self.id_key(infrag.get("id"))
 
-            # Ajouter des IDs uniques si manquants
-            for i, infrag in enumerate(infrags):
-                if 'id' not in infrag:
-                    infrag['id'] = f"{infrag.get('user_id', 'unknown')}_{infrag.get('user_context', 'unknown')}_{i}"
+    def ordered(self, user_id, user_context):
+        # called with self.lock held, sorted once per filter and generation,
+        # the writes then keep it in order
+        ordered = self.orders.get((user_id, user_context))
+        if ordered is not None:
+            return ordered
+        if user_id or user_context:
+            records = itertools.chain.from_iterable(
+                partition.infrags.values()
+                for (partition_user_id, partition_context), partition in self.partitions.items()
+                if (not user_id or partition_user_id == user_id)
+                and (not user_context or partition_context == user_context)
+            )
+        else:
+            records = self.infrags
+        ordered = sorted(records, key=self.order_key)
+        if ordered:
+            # no entry for filters matching nothing, any string can be asked
+            self.orders[(user_id, user_context)] = ordered
+        return ordered
 
-            # Filtrer si nécessaire
-            if user_id:
-                infrags = [infrag for infrag in infrags if infrag.get('user_id') == user_id]
+    def order_filters(self, infrag):
+        # the cached orders this record belongs to
+        for (user_id, user_context), ordered in self.orders.items():
+            if (not user_id or infrag.get("user_id") == user_id) and (
+                not user_context or infrag.get("user_context") == user_context
+            ):
+                yield ordered
 
-            if user_context:
-                infrags = [infrag for infrag in infrags if infrag.get('user_context') == user_context]
+    def order_add(self, infrag):
+        # called with self.lock held; new ids are allocated in increasing
+        # order and go at the end, others (synced, uploaded) by bisection
+        key = self.order_key(infrag)
+        for ordered in self.order_filters(infrag):
+            if not ordered or key >= self.order_key(ordered[-1]):
+                ordered.append(infrag)
+            else:
+                bisect.insort_right(ordered, infrag, key=self.order_key)
 
-            return infrags
+    def order_remove(self, infrag):
+        # called with self.lock held, the record is found among those
+        # sharing its id
+        key = self.order_key(infrag)
+        for ordered in self.order_filters(infrag):
+            pos = bisect.bisect_left(ordered, key, key=self.order_key)
+            end = bisect.bisect_right(ordered, key, lo=pos, key=self.order_key)
+            for pos in range(pos, end):
+                if ordered[pos] is infrag:
+                    del ordered[pos]
+                    break
 
-        except Exception as e:
-            print(f"Erreur lors de la récupération des fragments: {e}")
-            return []
+    # One page of records in id order, after the id `cursor`, read from
+    # memory: the order of each filter is sorted once then kept by the
+    # writes, the page starts at the cursor by bisection. Ids do not change with reloads or
+    # updates, so a cursor stays valid across workers and generations;
+    # records sharing an id end up on the same page. Dates are "YYYY-MM-DD"
+    # strings compared to storage_date, `fields` limits the keys returned.
+    # Returns (records, cursor of the next page or None).
+    def page_infrags(
+        self,
+        user_id=None,
+        user_context=None,
+        date_from=None,
+        date_to=None,
+        cursor=None,
+        limit=100,
+        fields=None,
+    ):
+        self.sync()
+        with self.lock:
+            records = self.ordered(user_id, user_context)
+            start = 0
+            if cursor is not None:
+                start = bisect.bisect_right(records, self.id_key(cursor), key=self.order_key)
+            page = []
+            last = None
+            for infrag in itertools.islice(records, start, None):
+                key = self.id_key(infrag.get("id"))
+                if len(page) >= limit and key != self.id_key(last):
+                    return page, last
+                storage_date = infrag.get("storage_date") or ""
+                if (date_from and storage_date < date_from) or (date_to and storage_date > date_to):
+                    continue
+                if fields:
+                    page.append({name: infrag[name] for name in fields if name in infrag})
+                else:
+                    page.append(dict(infrag))
+                last = infrag.get("id")
+            return page, None
 
     def get_is_local(self):
         """Méthode helper pour déterminer si on est en local"""
@@ -0,0 +1,98 @@
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter
+
+# words too common to tell two fragments apart (accents already removed)
+STOPWORDS = frozenset("""
+le la les un une des du de au aux et ou en dans sur sous pour par avec sans chez ce cet cette ces
+je tu il elle on nous vous ils elles me te se moi toi lui leur leurs y
+mon ma mes ton ta tes son sa ses notre nos votre vos
+qui que quoi dont quel quelle quels quelles est sont suis es etes sommes ai as avons avez ont
+etait ete etre avoir fait pas ne plus tres mais donc car si qu
+the an of to in on at and or is are was were be been it its this that my your his her our their
+what who whom which when where why how do does did not with for from by as
+""".split())
+
+# lower case words without accents, single letters (elisions) and stopwords dropped
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [word for word in re.findall(r"\w+", text) if (len(word) > 1 or word.isdigit()) and word not in STOPWORDS]
+
+# Merges ranked lists of fragments: each one adds 1 / (constant + rank)
+# to the fragments it holds, so a fragment found by both the vector and
+# the keyword search comes first without comparing their scores.
+def reciprocal_rank_fusion(rankings, k, constant=60):
+    scores = {}
+    infrags = {}
+    for ranking in rankings:
+        for rank, infrag in enumerate(ranking):
+            key = id(infrag)
+            infrags[key] = infrag
+            scores[key] = scores.get(key, 0.0) + 1.0 / (constant + rank + 1)
+    top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+    return [infrags[key] for key, _ in top]
+
+# This class is a BM25 inverted index over the texts of the fragments of
+# one partition, kept up to date with it, for names, places and dates
+# that embeddings match poorly. The terms of every fragment are kept so
+# it can be removed after its text was changed in place.
+class KeywordIndex:
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # term -> {id(infrag): term frequency}
+        self.docs = {}      # id(infrag) -> (infrag, length, terms)
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, infrag):
+        self.remove(infrag)
+        counts = Counter(tokenize(infrag.get("text") or ""))
+        key = id(infrag)
+        length = sum(counts.values())
+        self.docs[key] = (infrag, length, counts)
+        self.total_length += length
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[key] = count
+
+    def remove(self, infrag):
+        key = id(infrag)
+        doc = self.docs.pop(key, None)
+        if doc is None:
+            return
+        self.total_length -= doc[1]
+        for term in doc[2]:
+            postings = self.postings[term]
+            del postings[key]
+            if not postings:
+                del self.postings[term]
+
+    # True when every term is in at least one fragment
+    def covers(self, terms):
+        return all(term in self.postings for term in terms)
+
+    def search(self, terms, k=10):
+        if not self.docs:
+            return []
+        count = len(self.docs)
+        average = self.total_length / count or 1.0
+        scores = {}
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for key, frequency in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.docs[key][1] / average)
+                scores[key] = scores.get(key, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [self.docs[key][0] for key, _ in top]
+
+    def stats(self):
+        return {"documents": len(self.docs), "terms": len(self.postings)}
@@ -2,7 +2,8 @@ import json
 import faiss
 import os
 import numpy as np
-from infrags_mgr.embedder import Embedder # vectorization lib
+from infrags_mgr.embedder import get_embedder # vectorization lib
+from infrags_mgr.index_file import corpus_fingerprint, load_index, save_index
 
 class MemoryStore:
 
@@ -13,7 +14,7 @@ class MemoryStore:
     ):
         self.json_path = json_path
         self.index_path = index_path
-        self.embedder = Embedder()
+        self.embedder = get_embedder()
         self.dim = 384
 
         os.makedirs("data", exist_ok=True)
@@ -23,7 +24,14 @@ class MemoryStore:
         self.id_map = []
 
         if self.memories:
-            self.rebuild_index()
+            # reuse the saved index when the memories did not change
+            index = load_index(self.index_path, corpus_fingerprint(self.memories))
+            if index is not None:
+                self.index = index
+                self.id_map = [mem["id"] for mem in self.memories]
+            else:
+                self.rebuild_index()
+                self.save_index()
 
     def load_memories(self):
         if os.path.exists(self.json_path):
@@ -46,17 +54,20 @@ class MemoryStore:
         self.index.add(np.array([vec]).astype("float32"))
         self.id_map.append(memory_id)
         self.save_memories()
+        self.save_index()
+
+    def save_index(self):
+        try:
+            save_index(self.index, self.index_path, corpus_fingerprint(self.memories))
+        except Exception as e:
+            print(f"Erreur lors de la sauvegarde de l'index: {e}")
 
     def rebuild_index(self):
-        vectors = []
-        self.id_map = []
-        for i, mem in enumerate(self.memories):
-            vec = self.embedder.embed(mem["text"])
-            vectors.append(vec)
-            self.id_map.append(mem["id"])
-        self.index.add(np.array(vectors).astype("float32"))
+        self.id_map = [mem["id"] for mem in self.memories]
+        vectors = self.embedder.embed_many([mem["text"] for mem in self.memories])
+        self.index.add(vectors)
 
     def search_memories(self, query, k=10):
-        vec = self.embedder.embed(query)
+        vec = self.embedder.embed_query(query)
         D, I = self.index.search(np.array([vec]).astype("float32"), k)
         return [self.memories[self.id_map[i]] for i in I[0]]
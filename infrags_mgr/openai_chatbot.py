@@ -1,11 +1,14 @@
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import os
 
 from dotenv import load_dotenv
 load_dotenv()
 
+# OPENAI_BASE_URL, when set, points the client to another server
+# (e.g. infrags_mgr/fake_llm_server.py for local tests)
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # This class is used to interact with the OpenAI API
 # and to generate responses based on the user's information
@@ -13,9 +16,11 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 class OpenAIChatbot:
 
   # initializes the chatbot with a specific model.
-  def __init__(self, model="gpt-3.5-turbo"):
+  def __init__(self, model="gpt-3.5-turbo", timeout=60):
     self.model = model
     self.llm = "OpenAI"
+    # seconds allowed for one call of the async methods
+    self.timeout = timeout
 
   # This method is used to ask a question to the chatbot
   # based on the user's memories.
@@ -58,7 +63,8 @@ class OpenAIChatbot:
     self,
     question,
     instructions,
-    infrags
+    infrags,
+    language="fr-FR"
   ):
     # print("starting chatbot queryInfrags")
     # print("chatbot is: "+self.llm)
@@ -90,7 +96,7 @@ class OpenAIChatbot:
     return response
 
   # this method is generic to invoke chat gpt
-  def askLLM(self, user_id, instructions, request):
+  def askLLM(self, user_id, instructions, request, language="fr-FR"):
     # print("starting chatbot ask-llm")
     # print("chatbot is: "+self.llm)
     # print("question to chatbot ask-llm: "+request)
@@ -105,3 +111,74 @@ class OpenAIChatbot:
     response = response.choices[0].message.content.strip()
     # print("response from chatbot ask-llm: "+response)
     return response
+
+  # builds the messages used to answer a question
+  # from the user's information fragments.
+  def infragsMessages(self, question, instructions, infrags):
+    context = "\n".join(
+      [f"- {m['text']} ({m['storage_date']})" for m in infrags]
+    )
+    prompt = f"""
+      {instructions}
+      Voici les éléments d'information pertinents : {context}
+      Voici la question : {question}
+      Répond de manière claire, bienveillante, et uniquement
+      en te basant sur les éléments d'information pertinents.
+
+    """
+    return [
+      {"role": "system", "content": "Tu es un assistant mémoire personnel."},
+      {"role": "user", "content": prompt}
+    ]
+
+  # async call to OpenAI, bounded by self.timeout
+  async def completeAsync(self, messages):
+    try:
+      response = await async_client.chat.completions.create(
+        model=self.model,
+        messages=messages,
+        temperature=0.7,
+        timeout=self.timeout
+      )
+      response = response.choices[0].message.content.strip()
+    except Exception as e:
+      print(f"Error calling OpenAI API: {e}")
+      response = "Désolé, une erreur est survenue lors de la génération de la réponse."
+    return response
+
+  # async version of queryInfrags
+  async def queryInfragsAsync(self, question, instructions, infrags, language="fr-FR"):
+    return await self.completeAsync(self.infragsMessages(question, instructions, infrags))
+
+  # async version of askLLM
+  async def askLLMAsync(self, user_id, instructions, request, language="fr-FR"):
+    return await self.completeAsync([
+      {"role": "user", "content": f"{instructions}\n{request}"}
+    ])
+
+  # yields the text of the answer chunk by chunk, as OpenAI produces it
+  async def streamMessages(self, messages):
+    try:
+      stream = await async_client.chat.completions.create(
+        model=self.model,
+        messages=messages,
+        temperature=0.7,
+        stream=True,
+        timeout=self.timeout
+      )
+      async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+          yield chunk.choices[0].delta.content
+    except Exception as e:
+      print(f"Error calling OpenAI API: {e}")
+      yield "Désolé, une erreur est survenue lors de la génération de la réponse."
+
+  # streaming version of queryInfrags
+  def queryInfragsStream(self, question, instructions, infrags, language="fr-FR"):
+    return self.streamMessages(self.infragsMessages(question, instructions, infrags))
+
+  # streaming version of askLLM
+  def askLLMStream(self, user_id, instructions, request, language="fr-FR"):
+    return self.streamMessages([
+      {"role": "user", "content": f"{instructions}\n{request}"}
+    ])
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# This class keeps recent LLM answers, keyed on a hash of everything
+# that went into the prompt. Entries expire after ttl seconds, the
+# least recently used ones are dropped beyond max_entries / max_bytes,
+# and every entry built from a fragment is dropped when that fragment
+# is updated or deleted.
+class ResponseCache:
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (response, created, fragment ids)
+        self.keys_by_fragment = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, method, instructions, infrags, question, language):
+        payload = json.dumps(
+            [
+                model,
+                method,
+                instructions,
+                [[str(i.get("id")), i.get("text")] for i in infrags],
+                question,
+                language,
+            ],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, response, fragment_ids=()):
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            fragment_ids = [str(i) for i in fragment_ids]
+            self.entries[key] = (response, time.monotonic(), fragment_ids)
+            self.bytes += size
+            for fragment_id in fragment_ids:
+                self.keys_by_fragment.setdefault(fragment_id, set()).add(key)
+            while self.entries and (
+                len(self.entries) > self.max_entries or self.bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        response, _, fragment_ids = self.entries.pop(key)
+        self.bytes -= len(response.encode("utf-8"))
+        for fragment_id in fragment_ids:
+            keys = self.keys_by_fragment.get(fragment_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_fragment[fragment_id]
+
+    def invalidate_fragment(self, fragment_id):
+        with self.lock:
+            for key in list(self.keys_by_fragment.get(str(fragment_id), ())):
+                self._drop(key)
+                self.invalidations += 1
+
+    # InfragStore listener
+    def on_infrag_changed(self, event, infrag):
+        if event in ("update", "delete"):
+            self.invalidate_fragment(infrag.get("id"))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+# This class wraps GoogleChatbot or OpenAIChatbot and answers from the
+# ResponseCache when the exact same prompt was sent recently.
+# Streaming methods and attributes go straight to the wrapped chatbot.
+class CachedChatbot:
+
+    # error answers are not worth keeping
+    ERROR_PREFIX = "Désolé, une erreur est survenue"
+
+    def __init__(self, chatbot, cache):
+        self.chatbot = chatbot
+        self.cache = cache
+        model = chatbot.model
+        self.model_name = model if isinstance(model, str) else getattr(model, "model_name", str(model))
+
+    def __getattr__(self, name):
+        return getattr(self.chatbot, name)
+
+    def store(self, key, response, infrags):
+        if response and not response.startswith(self.ERROR_PREFIX):
+            self.cache.put(key, response, [i.get("id") for i in infrags])
+
+    def queryInfrags(self, question, instructions, infrags, language="fr-FR"):
+        key = self.cache.make_key(self.model_name, "queryInfrags", instructions, infrags, question, language)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.chatbot.queryInfrags(question, instructions, infrags, language)
+            self.store(key, response, infrags)
+        return response
+
+    async def queryInfragsAsync(self, question, instructions, infrags, language="fr-FR"):
+        key = self.cache.make_key(self.model_name, "queryInfrags", instructions, infrags, question, language)
+        response = self.cache.get(key)
+        if response is None:
+            response = await self.chatbot.queryInfragsAsync(question, instructions, infrags, language)
+            self.store(key, response, infrags)
+        return response
+
+    def askLLM(self, user_id, instructions, request, language="fr-FR"):
+        key = self.cache.make_key(self.model_name, "askLLM", instructions, [], request, language)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.chatbot.askLLM(user_id, instructions, request, language)
+            self.store(key, response, [])
+        return response
+
+    async def askLLMAsync(self, user_id, instructions, request, language="fr-FR"):
+        key = self.cache.make_key(self.model_name, "askLLM", instructions, [], request, language)
+        response = self.cache.get(key)
+        if response is None:
+            response = await self.chatbot.askLLMAsync(user_id, instructions, request, language)
+            self.store(key, response, [])
+        return response
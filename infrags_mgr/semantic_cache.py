@@ -0,0 +1,86 @@
+import threading
+import time
+import numpy as np
+
+# This class keeps, per (user_id, user_context), the last answers with
+# the embedding of the question that produced them. A new question
+# whose embedding is close enough (cosine >= threshold) to a cached one
+# gets the cached answer, as long as the tenant's fragments did not
+# change since (same partition version) and the instructions and
+# language (the "scope") are the same. Questions answered by the keyword
+# search alone are not embedded, their answers are kept under the set of
+# their search terms and only an identical set finds them.
+class SemanticCache:
+
+    def __init__(self, threshold=0.92, max_entries_per_tenant=256, ttl=3600):
+        self.threshold = threshold
+        self.max_entries_per_tenant = max_entries_per_tenant
+        self.ttl = ttl
+        # tenant -> list of [unit vector or None, answer, version, scope,
+        # created, frozenset of terms or None]
+        self.tenants = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def unit(vec):
+        vec = np.asarray(vec, dtype="float32")
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    # terms are only used when vec is None
+    def lookup(self, tenant, scope, vec, version, terms=None):
+        if vec is None and not terms:
+            return None
+        query = None if vec is None else self.unit(vec)
+        key = frozenset(terms) if vec is None else None
+        now = time.monotonic()
+        with self.lock:
+            entries = self.tenants.get(tenant)
+            if entries:
+                # answers built on older fragments can never be used again
+                entries[:] = [
+                    e for e in entries if e[2] == version and now - e[4] <= self.ttl
+                ]
+            entry = None
+            if query is None:
+                entry = next((e for e in entries or [] if e[3] == scope and e[5] == key), None)
+            else:
+                candidates = [e for e in entries or [] if e[3] == scope and e[0] is not None]
+                if candidates:
+                    scores = np.stack([e[0] for e in candidates]) @ query
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.threshold:
+                        entry = candidates[best]
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # most recently used at the end; by identity, entries hold
+            # arrays that == does not compare
+            pos = next(i for i, e in enumerate(entries) if e is entry)
+            entries.append(entries.pop(pos))
+            return entry[1]
+
+    def store(self, tenant, scope, vec, version, answer, terms=None):
+        if vec is None and not terms:
+            return
+        unit = None if vec is None else self.unit(vec)
+        key = frozenset(terms) if vec is None else None
+        with self.lock:
+            entries = self.tenants.setdefault(tenant, [])
+            entries.append([unit, answer, version, scope, time.monotonic(), key])
+            del entries[:-self.max_entries_per_tenant]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "threshold": self.threshold,
+                "tenants": len(self.tenants),
+                "entries": sum(len(e) for e in self.tenants.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,262 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+import speech_recognition as sr
+
+class AudioTooLarge(Exception):
+
+    def __init__(self, size, max_bytes):
+        super().__init__(f"audio larger than {max_bytes} bytes")
+        self.size = size
+        self.max_bytes = max_bytes
+
+# Recognizer backends: recognize(audio, language) takes an sr.AudioData
+# and returns the text, raising sr.UnknownValueError / sr.RequestError
+# like speech_recognition does.
+
+class GoogleRecognizer:
+
+    name = "google"
+
+    def __init__(self):
+        self.recognizer = sr.Recognizer()
+
+    def recognize(self, audio, language):
+        return self.recognizer.recognize_google(audio, language=language)
+
+# This class stands in for a real recognizer in benchmarks: it takes
+# seconds_per_audio_second of wall time per second of audio and returns
+# a fixed text.
+class FakeRecognizer:
+
+    name = "fake"
+
+    def __init__(self, text="transcription", seconds_per_audio_second=0.1):
+        self.text = text
+        self.seconds_per_audio_second = seconds_per_audio_second
+
+    def recognize(self, audio, language):
+        time.sleep(duration(audio) * self.seconds_per_audio_second)
+        return self.text
+
+RECOGNIZERS = {
+    "google": GoogleRecognizer,
+    "fake": FakeRecognizer,
+}
+
+def get_recognizer(name="google"):
+    try:
+        return RECOGNIZERS[name]()
+    except KeyError:
+        raise ValueError(f"unknown recognizer {name}, expected one of {sorted(RECOGNIZERS)}")
+
+def duration(audio):
+    return len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+
+# Cuts audio into segments of about window_seconds, each one starting
+# overlap_seconds before the end of the previous one. When the samples
+# are 16 bits, every cut is moved to the quietest 20 ms of the last
+# search_seconds of its window so that words are rarely cut in two.
+def split_audio(audio, window_seconds=30, overlap_seconds=1, search_seconds=2):
+    frame_bytes = audio.sample_width
+    total = len(audio.frame_data) // frame_bytes
+    window = int(window_seconds * audio.sample_rate)
+    overlap = int(overlap_seconds * audio.sample_rate)
+    search = int(search_seconds * audio.sample_rate)
+    step = max(1, audio.sample_rate // 50)
+    samples = None
+    if audio.sample_width == 2:
+        samples = np.frombuffer(audio.frame_data, dtype="<i2").astype("float32")
+    segments = []
+    start = 0
+    while start < total:
+        end = min(start + window, total)
+        if end < total and samples is not None and search > step:
+            lo = max(start + overlap + step, end - search)
+            frames = samples[lo:end][: (end - lo) // step * step].reshape(-1, step)
+            if len(frames):
+                end = lo + int(np.argmin(np.sqrt((frames ** 2).mean(axis=1)))) * step + step // 2
+        segments.append(sr.AudioData(
+            audio.frame_data[start * frame_bytes:end * frame_bytes],
+            audio.sample_rate,
+            audio.sample_width,
+        ))
+        if end >= total:
+            break
+        start = max(end - overlap, start + 1)
+    return segments
+
+# Joins segment transcripts in order. Words repeated because of the
+# overlap (up to max_overlap_words, compared case-insensitively) are
+# only kept once.
+def stitch(texts, max_overlap_words=8):
+    words = []
+    for text in texts:
+        new_words = text.split()
+        for k in range(min(max_overlap_words, len(words), len(new_words)), 0, -1):
+            if [w.lower() for w in words[-k:]] == [w.lower() for w in new_words[:k]]:
+                new_words = new_words[k:]
+                break
+        words.extend(new_words)
+    return " ".join(words)
+
+# This class keeps a copy of uploaded audio for debugging.
+# mode "off" keeps nothing, "errors" keeps the audio of failed
+# transcriptions, "all" keeps everything. Only the newest max_files
+# files are kept.
+class AudioRetention:
+
+    MODES = ("off", "errors", "all")
+
+    def __init__(self, directory="uploaded_files/stt", mode="off", max_files=100):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown retention mode {mode}, expected one of {self.MODES}")
+        self.directory = directory
+        self.mode = mode
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.kept = 0
+
+    def wants(self, failed):
+        return self.mode == "all" or (self.mode == "errors" and failed)
+
+    def keep(self, stream, filename):
+        os.makedirs(self.directory, exist_ok=True)
+        ts = datetime.now().strftime("%Y-%m-%d@%H-%M-%S-%f")
+        base, ext = os.path.splitext(os.path.basename(filename or "audio"))
+        file_path = os.path.join(self.directory, f"{base}_{ts}{ext}")
+        stream.seek(0)
+        with open(file_path, "wb") as f:
+            shutil.copyfileobj(stream, f)
+        with self.lock:
+            self.kept += 1
+            self.prune()
+        return file_path
+
+    def prune(self):
+        files = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if os.path.isfile(os.path.join(self.directory, name))
+        ]
+        files.sort(key=os.path.getmtime)
+        for file_path in files[:-self.max_files] if self.max_files else files:
+            os.remove(file_path)
+
+# This class turns an uploaded audio stream into text without writing
+# it to disk: the stream is decoded where it is when it can seek (the
+# FastAPI upload is already spooled), otherwise it is copied into a
+# SpooledTemporaryFile that stays in memory up to spool_bytes.
+# Uploads over max_bytes are refused. Audio longer than segment_seconds
+# is split (see split_audio) and the segments are recognized by
+# `workers` threads; segments that fail are reported and left out.
+class SpeechToText:
+
+    def __init__(
+        self,
+        recognizer,
+        max_bytes=25 * 1024 * 1024,
+        spool_bytes=4 * 1024 * 1024,
+        retention=None,
+        segment_seconds=30,
+        overlap_seconds=1,
+        workers=4,
+    ):
+        self.recognizer = recognizer
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.retention = retention or AudioRetention()
+        self.segment_seconds = segment_seconds
+        self.overlap_seconds = overlap_seconds
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stt-segment")
+        self.lock = threading.Lock()
+        self.segments = 0
+        self.failed_segments = 0
+
+    def spool(self, stream):
+        if stream.seekable():
+            stream.seek(0, os.SEEK_END)
+            size = stream.tell()
+            if size > self.max_bytes:
+                raise AudioTooLarge(size, self.max_bytes)
+            stream.seek(0)
+            return stream
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        size = 0
+        while True:
+            chunk = stream.read(64 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > self.max_bytes:
+                spooled.close()
+                raise AudioTooLarge(size, self.max_bytes)
+            spooled.write(chunk)
+        spooled.seek(0)
+        return spooled
+
+    def decode(self, stream):
+        with sr.AudioFile(stream) as source:
+            return sr.Recognizer().record(source)
+
+    def recognize_segment(self, segment, language):
+        try:
+            return self.recognizer.recognize(segment, language), None
+        except Exception as e:
+            return None, e
+
+    # returns {"text", "segments", "failed_segments"}; raises the error
+    # of the first segment when none could be recognized
+    def recognize(self, audio, language):
+        if duration(audio) <= self.segment_seconds:
+            segments = [audio]
+        else:
+            segments = split_audio(audio, self.segment_seconds, self.overlap_seconds)
+        if len(segments) == 1:
+            results = [self.recognize_segment(segments[0], language)]
+        else:
+            results = list(self.executor.map(
+                lambda segment: self.recognize_segment(segment, language), segments
+            ))
+        failed = [i for i, (_, error) in enumerate(results) if error is not None]
+        with self.lock:
+            self.segments += len(segments)
+            self.failed_segments += len(failed)
+        if len(failed) == len(results):
+            raise results[0][1]
+        return {
+            "text": stitch([text for text, _ in results if text is not None]),
+            "segments": len(segments),
+            "failed_segments": failed,
+        }
+
+    def transcribe(self, stream, language, filename=None):
+        audio_stream = self.spool(stream)
+        failed = True
+        try:
+            result = self.recognize(self.decode(audio_stream), language)
+            failed = bool(result["failed_segments"])
+            return result
+        finally:
+            if self.retention.wants(failed):
+                self.retention.keep(audio_stream, filename)
+            if audio_stream is not stream:
+                audio_stream.close()
+
+    def stats(self):
+        return {
+            "recognizer": self.recognizer.name,
+            "max_bytes": self.max_bytes,
+            "segment_seconds": self.segment_seconds,
+            "workers": self.workers,
+            "segments": self.segments,
+            "failed_segments": self.failed_segments,
+            "retention": self.retention.mode,
+            "retained_files": self.retention.kept,
+        }
@@ -0,0 +1,42 @@
+import argparse
+import io
+import time
+import wave
+import numpy as np
+from infrags_mgr.speech_to_text import FakeRecognizer, SpeechToText
+
+# Measures /speech-to-text segmentation with the fake recognizer: the
+# wall time for a long recording should shrink with the number of
+# segment workers.
+#   python -m infrags_mgr.stt_benchmark --seconds 300 --workers 1 2 4 8
+
+def synthetic_wav(seconds, sample_rate=16000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    # one "word" of tone every second, silence in between
+    samples = np.sin(2 * np.pi * 220 * t) * 8000 * ((t % 1.0) < 0.6)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.astype("<i2").tobytes())
+    return buffer.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=300)
+    parser.add_argument("--segment-seconds", type=float, default=30)
+    parser.add_argument("--seconds-per-audio-second", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    audio = synthetic_wav(args.seconds)
+    recognizer = FakeRecognizer(seconds_per_audio_second=args.seconds_per_audio_second)
+    for workers in args.workers:
+        speech_to_text = SpeechToText(recognizer, segment_seconds=args.segment_seconds, workers=workers)
+        start = time.perf_counter()
+        result = speech_to_text.transcribe(io.BytesIO(audio), "fr-FR")
+        elapsed = time.perf_counter() - start
+        print(f"workers={workers} segments={result['segments']} seconds={elapsed:.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+logger = logging.getLogger(__name__)
+
+# Raised on writes once a file could not be written back to the bucket
+# because another writer changed it: the local changes would be lost on
+# the next start, the instance must be restarted to pull the new files.
+class StorageConflict(Exception):
+
+    def __init__(self, names):
+        super().__init__(f"bucket files changed by another writer: {', '.join(names)}")
+        self.names = names
+
+# This class is a stand-in for a google.cloud.storage Bucket backed by a
+# local directory, with the few blob methods TieredSync uses and the
+# same generation numbers / if_generation_match behaviour, for tests.
+class LocalBucket:
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+class LocalBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    def current_generation(self):
+        try:
+            with open(self.path() + ".generation", "r") as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def exists(self):
+        return os.path.exists(self.path())
+
+    def reload(self):
+        if not self.exists():
+            raise NotFound(f"{self.name} not found")
+        self.generation = self.current_generation()
+
+    def delete(self, if_generation_match=None):
+        with self.bucket.lock:
+            current = self.current_generation() if self.exists() else 0
+            if if_generation_match is not None and if_generation_match != current:
+                raise PreconditionFailed(f"{self.name}: generation {current}, expected {if_generation_match}")
+            if not self.exists():
+                raise NotFound(f"{self.name} not found")
+            os.remove(self.path())
+
+    def download_to_filename(self, filename):
+        if not self.exists():
+            raise NotFound(f"{self.name} not found")
+        shutil.copyfile(self.path(), filename)
+        self.generation = self.current_generation()
+
+    def upload_from_filename(self, filename, if_generation_match=None):
+        with self.bucket.lock:
+            current = self.current_generation() if self.exists() else 0
+            if if_generation_match is not None and if_generation_match != current:
+                raise PreconditionFailed(f"{self.name}: generation {current}, expected {if_generation_match}")
+            os.makedirs(os.path.dirname(self.path()) or ".", exist_ok=True)
+            shutil.copyfile(filename, self.path() + ".tmp")
+            os.replace(self.path() + ".tmp", self.path())
+            self.generation = current + 1
+            with open(self.path() + ".generation", "w") as f:
+                f.write(str(self.generation))
+
+# This class keeps the store files on local disk and copies them to a
+# bucket (google.cloud.storage or LocalBucket) in the background:
+# mark_dirty() asks for a flush, which happens once no new change came
+# for `debounce` seconds (or at most `max_delay` seconds after the first
+# one). barrier() flushes at once and returns when the files are in the
+# bucket. Every upload is conditional on the generation seen at the last
+# download/upload, so a file changed by another writer is never
+# overwritten: the conflict is logged, that file is no longer flushed
+# and check_writable() refuses the next writes. The processes of one machine share the known generations
+# through a file, under a file lock.
+class TieredSync:
+
+    def __init__(self, bucket, local_dir, prefix="", debounce=2.0, max_delay=30.0):
+        self.bucket = bucket
+        self.local_dir = local_dir
+        self.prefix = prefix
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.files = {}  # name -> prepare(tmp_path) or None
+        self.uploaded = {}  # name -> (mtime_ns, size) of the last upload
+        self.conflicts = {}  # name -> error
+        self.flushes = 0
+        self.uploads = 0
+        self.last_flush = None
+        self.last_error = None
+        self.dirty_since = None
+        self.changed_at = None
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.generations_path = os.path.join(local_dir, ".generations.json")
+        os.makedirs(local_dir, exist_ok=True)
+        self.worker = threading.Thread(target=self.run, name="tiered-sync", daemon=True)
+        self.worker.start()
+
+    def local_path(self, name):
+        return os.path.join(self.local_dir, name)
+
+    def blob_name(self, name):
+        return self.prefix + name
+
+    # prepare(tmp_path), when given, writes a consistent copy of the file
+    # (e.g. a SQLite backup), otherwise the file itself is copied
+    def track(self, name, prepare=None):
+        self.files[name] = prepare
+
+    def shared_generations(self):
+        # called with the file lock held
+        try:
+            with open(self.generations_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_generations(self, generations):
+        tmp_path = f"{self.generations_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(generations, f)
+        os.replace(tmp_path, self.generations_path)
+
+    def locked(self):
+        lock_file = open(self.generations_path + ".lock", "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    # downloads the tracked files that are not on local disk yet
+    def pull(self):
+        lock_file = self.locked()
+        try:
+            generations = self.shared_generations()
+            for name in self.files:
+                path = self.local_path(name)
+                if os.path.exists(path) and name in generations:
+                    continue
+                blob = self.bucket.blob(self.blob_name(name))
+                try:
+                    blob.download_to_filename(path + ".download")
+                    os.replace(path + ".download", path)
+                    generations[name] = blob.generation
+                except NotFound:
+                    if os.path.exists(path + ".download"):
+                        os.remove(path + ".download")
+                    # must still not exist when it is first uploaded
+                    generations.setdefault(name, 0)
+                stat = os.stat(path) if os.path.exists(path) else None
+                self.uploaded[name] = (stat.st_mtime_ns, stat.st_size) if stat else None
+            self.save_generations(generations)
+        finally:
+            lock_file.close()
+
+    def mark_dirty(self):
+        with self.condition:
+            now = time.monotonic()
+            if self.dirty_since is None:
+                self.dirty_since = now
+            self.changed_at = now
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.dirty_since is None:
+                    self.condition.wait()
+                now = time.monotonic()
+                due = min(self.changed_at + self.debounce, self.dirty_since + self.max_delay)
+                if now < due:
+                    self.condition.wait(due - now)
+                    continue
+                self.dirty_since = None
+                self.changed_at = None
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            lock_file = self.locked()
+            try:
+                generations = self.shared_generations()
+                for name, prepare in self.files.items():
+                    if name in self.conflicts:
+                        continue
+                    self.flush_file(name, prepare, generations)
+                self.save_generations(generations)
+                self.flushes += 1
+                self.last_flush = time.time()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Erreur lors de l'envoi vers le bucket: {e}")
+            finally:
+                lock_file.close()
+        return not self.conflicts and self.last_error is None
+
+    def flush_file(self, name, prepare, generations):
+        path = self.local_path(name)
+        if not os.path.exists(path):
+            # gone locally (e.g. a log folded into the snapshot), an old
+            # copy left in the bucket would be replayed on the next start
+            if generations.get(name):
+                try:
+                    self.bucket.blob(self.blob_name(name)).delete(if_generation_match=generations[name])
+                except NotFound:
+                    pass
+                except PreconditionFailed as e:
+                    self.conflict(name, e)
+                    return
+                generations[name] = 0
+                self.uploaded[name] = None
+            return
+        stat = os.stat(path)
+        if self.uploaded.get(name) == (stat.st_mtime_ns, stat.st_size):
+            return
+        tmp_path = f"{path}.{os.getpid()}.upload"
+        try:
+            if prepare is not None:
+                prepare(tmp_path)
+            else:
+                shutil.copyfile(path, tmp_path)
+            blob = self.bucket.blob(self.blob_name(name))
+            try:
+                blob.upload_from_filename(tmp_path, if_generation_match=generations.get(name, 0))
+            except PreconditionFailed as e:
+                self.conflict(name, e)
+                return
+            generations[name] = blob.generation
+            self.uploaded[name] = (stat.st_mtime_ns, stat.st_size)
+            self.uploads += 1
+            self.last_error = None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def conflict(self, name, error):
+        self.conflicts[name] = str(error)
+        logger.error("Conflit d'écriture sur %s, un autre processus l'a modifié, écritures refusées: %s", name, error)
+
+    # raises StorageConflict once a file can no longer be written back
+    def check_writable(self):
+        if self.conflicts:
+            raise StorageConflict(sorted(self.conflicts))
+
+    # flushes now, True when every tracked file is in the bucket
+    def barrier(self):
+        with self.condition:
+            self.dirty_since = None
+            self.changed_at = None
+        return self.flush()
+
+    def stats(self):
+        with self.condition:
+            pending = self.dirty_since is not None
+        return {
+            "files": sorted(self.files),
+            "pending": pending,
+            "flushes": self.flushes,
+            "uploads": self.uploads,
+            "last_flush": self.last_flush,
+            "last_error": self.last_error,
+            "conflicts": dict(self.conflicts),
+        }
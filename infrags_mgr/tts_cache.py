@@ -0,0 +1,173 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from gtts import gTTS
+
+def gtts_synthesize(text, language, voice_type):
+    # gTTS has a single voice, voice_type only matters for the cache key
+    buffer = io.BytesIO()
+    gTTS(text, lang=language, slow=False).write_to_fp(buffer)
+    return buffer.getvalue()
+
+# This class caches synthesized speech by a hash of (text, language,
+# voice_type). Small files are kept in a memory LRU, all of them in a
+# disk LRU under `directory`. Concurrent requests for the same phrase
+# share a single synthesis.
+class TTSCache:
+
+    def __init__(
+        self,
+        directory="uploaded_files/tts_cache",
+        max_disk_bytes=256 * 1024 * 1024,
+        max_memory_bytes=32 * 1024 * 1024,
+        synthesize=gtts_synthesize,
+    ):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.synthesize = synthesize
+        self.memory = OrderedDict()  # key -> bytes
+        self.memory_bytes = 0
+        self.disk = OrderedDict()    # key -> size, oldest access first
+        self.disk_bytes = 0
+        self.in_flight = {}          # key -> Future
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.shared = 0
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    @staticmethod
+    def make_key(text, language, voice_type):
+        payload = "\0".join([text, language or "", voice_type or ""])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def scan(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".mp3"):
+                full_path = os.path.join(self.directory, name)
+                files.append((os.path.getmtime(full_path), name[:-4], os.path.getsize(full_path)))
+        for _, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_bytes += size
+        self.evict_disk()
+
+    # returns (key, audio bytes or None, file path)
+    def get(self, text, language, voice_type):
+        key = self.make_key(text, language, voice_type)
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return key, data, self.path(key)
+            if key in self.disk:
+                self.disk.move_to_end(key)
+                self.disk_hits += 1
+                on_disk = True
+            else:
+                on_disk = False
+                future = self.in_flight.get(key)
+                if future is None:
+                    future = Future()
+                    self.in_flight[key] = future
+                    owner = True
+                    self.misses += 1
+                else:
+                    owner = False
+                    self.shared += 1
+        if on_disk:
+            try:
+                os.utime(self.path(key))
+                if not self.fits_memory(os.path.getsize(self.path(key))):
+                    # served from the file (sendfile)
+                    return key, None, self.path(key)
+                with open(self.path(key), "rb") as f:
+                    data = f.read()
+                self.remember(key, data)
+                return key, data, self.path(key)
+            except FileNotFoundError:
+                with self.lock:
+                    self.forget_disk(key)
+                return self.get(text, language, voice_type)
+        if not owner:
+            data = future.result()
+            return key, data, self.path(key)
+        try:
+            data = self.synthesize(text, language, voice_type)
+            self.write(key, data)
+            self.remember(key, data)
+            future.set_result(data)
+            return key, data, self.path(key)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def write(self, key, data):
+        tmp_path = self.path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+        with self.lock:
+            if key in self.disk:
+                self.disk_bytes -= self.disk.pop(key)
+            self.disk[key] = len(data)
+            self.disk_bytes += len(data)
+            self.evict_disk()
+
+    def fits_memory(self, size):
+        # one phrase may not take more than 1/16 of the memory budget
+        return size <= self.max_memory_bytes // 16
+
+    def remember(self, key, data):
+        if not self.fits_memory(len(data)):
+            return
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = data
+            self.memory_bytes += len(data)
+            while self.memory_bytes > self.max_memory_bytes and self.memory:
+                _, old = self.memory.popitem(last=False)
+                self.memory_bytes -= len(old)
+
+    def forget_disk(self, key):
+        size = self.disk.pop(key, None)
+        if size is not None:
+            self.disk_bytes -= size
+
+    def evict_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses + self.shared
+            return {
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "shared_syntheses": self.shared,
+                "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            }
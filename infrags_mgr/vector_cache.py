@@ -0,0 +1,217 @@
+import hashlib
+import os
+import struct
+import threading
+import numpy as np
+
+# This class keeps the embedding of every information fragment on disk,
+# keyed by the fragment id plus a hash of its text, so that a fragment
+# is only embedded again when its text changes.
+# The file is an append-only list of records:
+#   key length (2 bytes), flag (1 byte), key, vector (dim float32)
+# a flag of 0 marks a deleted key (no vector follows).
+# With path=None the cache only lives in memory.
+# With resident=False only the offset of each vector in the file is kept
+# and the vector is read back on get (quantized partitions keep their
+# float32 vectors here); loader(pairs), given (infrag_id, text) pairs,
+# returns the vectors (or None) of keys the cache does not have.
+# Safe to use from the request threads and a background rebuild.
+class VectorCache:
+
+    HEADER = struct.Struct("<HB")
+
+    def __init__(self, path, dim=384, resident=True, loader=None):
+        self.path = path
+        self.dim = dim
+        self.vector_size = dim * 4
+        self.resident = resident
+        self.loader = loader
+        self.reader = None  # read-only file descriptor when not resident
+        self.vectors = {}   # key -> vector, or its offset in the file
+        self.keys_by_id = {}
+        self.dead_records = 0
+        self.lock = threading.RLock()
+        # the file is read on first use, a start from a saved index may never need it
+        self.loaded = False
+
+    @staticmethod
+    def make_key(infrag_id, text):
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return f"{infrag_id}:{digest}"
+
+    def ensure_loaded(self):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+
+    def load(self):
+        self.loaded = True
+        self.vectors = {}
+        self.keys_by_id = {}
+        self.dead_records = 0
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + self.HEADER.size <= len(data):
+            key_len, flag = self.HEADER.unpack_from(data, pos)
+            pos += self.HEADER.size
+            key = data[pos:pos + key_len].decode("utf-8")
+            pos += key_len
+            if flag:
+                if pos + self.vector_size > len(data):
+                    # truncated last record (crash during a write)
+                    break
+                vec = np.frombuffer(data, dtype="float32", count=self.dim, offset=pos)
+                if key in self.vectors:
+                    self.dead_records += 1
+                self._set(key, vec.copy() if self.resident else pos)
+                pos += self.vector_size
+            else:
+                self.dead_records += 1
+                if key in self.vectors:
+                    self.dead_records += 1
+                    self._unset(key)
+
+    def _set(self, key, vec):
+        self.vectors[key] = vec
+        infrag_id = key.rsplit(":", 1)[0]
+        self.keys_by_id.setdefault(infrag_id, set()).add(key)
+
+    def _unset(self, key):
+        self.vectors.pop(key, None)
+        infrag_id = key.rsplit(":", 1)[0]
+        keys = self.keys_by_id.get(infrag_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_id[infrag_id]
+
+    def _encode(self, key, vec=None):
+        key_bytes = key.encode("utf-8")
+        if vec is None:
+            return self.HEADER.pack(len(key_bytes), 0) + key_bytes
+        return (
+            self.HEADER.pack(len(key_bytes), 1)
+            + key_bytes
+            + np.ascontiguousarray(vec, dtype="float32").tobytes()
+        )
+
+    # returns the offset of the first record in the file
+    def _append(self, records):
+        if not self.path:
+            return None
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "ab") as f:
+            start = f.tell()
+            f.write(b"".join(records))
+        return start
+
+    def _read(self, value):
+        if value is None or isinstance(value, np.ndarray):
+            return value
+        if self.reader is None:
+            self.reader = os.open(self.path, os.O_RDONLY)
+        data = os.pread(self.reader, self.vector_size, value)
+        return np.frombuffer(data, dtype="float32").copy()
+
+    def _reopen(self):
+        if self.reader is not None:
+            os.close(self.reader)
+            self.reader = None
+
+    def preload(self, vectors):
+        with self.lock:
+            # key -> vector read from another storage, not written to the file
+            self.ensure_loaded()
+            for key, vec in vectors.items():
+                self._set(key, np.asarray(vec, dtype="float32").reshape(self.dim))
+
+    def get(self, infrag_id, text):
+        return self.get_many([(infrag_id, text)])[0]
+
+    def get_many(self, pairs):
+        with self.lock:
+            self.ensure_loaded()
+            vectors = [self._read(self.vectors.get(self.make_key(infrag_id, text))) for infrag_id, text in pairs]
+        missing = [pos for pos, vec in enumerate(vectors) if vec is None]
+        if missing and self.loader is not None:
+            for pos, vec in zip(missing, self.loader([pairs[pos] for pos in missing])):
+                vectors[pos] = vec
+        return vectors
+
+    def put(self, infrag_id, text, vec):
+        self.put_many([(infrag_id, text, vec)])
+
+    def put_many(self, items):
+        with self.lock:
+            # items is a list of (infrag_id, text, vec), written in one append
+            self.ensure_loaded()
+            records = []
+            keys = []
+            for infrag_id, text, vec in items:
+                key = self.make_key(infrag_id, text)
+                vec = np.asarray(vec, dtype="float32").reshape(self.dim)
+                if key in self.vectors:
+                    self.dead_records += 1
+                if self.resident:
+                    self._set(key, vec)
+                records.append(self._encode(key, vec))
+                keys.append(key)
+            if not records:
+                return
+            pos = self._append(records)
+            if not self.resident and pos is not None:
+                for key, record in zip(keys, records):
+                    pos += len(record)
+                    self._set(key, pos - self.vector_size)
+
+    def invalidate(self, infrag_id):
+        with self.lock:
+            self.ensure_loaded()
+            keys = list(self.keys_by_id.get(str(infrag_id), ()))
+            if not keys:
+                return
+            for key in keys:
+                self._unset(key)
+            self.dead_records += 2 * len(keys)
+            self._append([self._encode(key) for key in keys])
+
+    def compact(self, live_keys=None):
+        """Réécrit le fichier avec uniquement les clés encore utilisées"""
+        with self.lock:
+            self.ensure_loaded()
+            if live_keys is not None:
+                for key in [k for k in self.vectors if k not in live_keys]:
+                    self._unset(key)
+            self.dead_records = 0
+            if not self.path:
+                return
+            tmp_path = self.path + ".tmp"
+            offsets = {}
+            pos = 0
+            with open(tmp_path, "wb") as f:
+                for key, value in self.vectors.items():
+                    record = self._encode(key, self._read(value))
+                    f.write(record)
+                    pos += len(record)
+                    offsets[key] = pos - self.vector_size
+            os.replace(tmp_path, self.path)
+            self._reopen()
+            if not self.resident:
+                self.vectors.update(offsets)
+            self.dead_records = 0
+
+    def memory_bytes(self):
+        # rough: the key strings and dict entries, plus the vectors when resident
+        with self.lock:
+            per_key = 120 + (self.vector_size + 112 if self.resident else 32)
+            return len(self.vectors) * per_key
+
+    def needs_compaction(self):
+        with self.lock:
+            self.ensure_loaded()
+            return self.dead_records > max(64, len(self.vectors))
@@ -0,0 +1,254 @@
+import itertools
+import faiss
+import numpy as np
+from infrags_mgr.ann_index import AnnConfig
+from infrags_mgr.keyword_index import KeywordIndex
+
+# versions are unique across partitions, a rebuilt partition never
+# reuses the version of the one it replaces
+_versions = itertools.count(1)
+
+# This class holds the vectors of the information fragments of one
+# (user_id, user_context) pair, so a search never has to look at
+# other tenants. Every vector is stored under its own slot number
+# (IndexIDMap2) so a fragment can be replaced or removed on its own.
+# A partition may also start from a read-only "base" array (a slice of
+# a memory-mapped file shared by the uvicorn workers): base rows are
+# slots 0..len(base)-1, later adds and updates go to the FAISS index
+# and removed base rows are only masked.
+# Past config.promote_at fragments a partition also keeps an approximate
+# index (HNSW or IVF, see AnnConfig) over its slots and searches it
+# instead; slots are never reused, an update gives the fragment a new
+# one, so removed and replaced slots left in the approximate index are
+# skipped until it is rebuilt.
+# With config.quantizer the vectors (base rows included) move to a
+# scalar quantized index once the partition is large enough; the float32
+# vectors are then read back only for the candidates of a search, from
+# the base or through exact(infrags) -> list of vectors (None if unknown).
+# The texts are also indexed for keyword search (self.keywords, BM25).
+class VectorPartition:
+
+    def __init__(self, dim=384, config=None, exact=None):
+        self.dim = dim
+        self.config = config or AnnConfig()
+        self.exact = exact
+        self.ann = None
+        self.quantized = False
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        self.infrags = {}   # slot -> infrag
+        self.slots = {}     # id(infrag) -> slot
+        self.keywords = KeywordIndex()
+        self.next_slot = 0
+        self.base = None
+        self.base_alive = None
+        self.base_norms = None
+        # changes on every add/update/remove
+        self.version = next(_versions)
+
+    @classmethod
+    def from_base(cls, infrags, base, dim=384, config=None, exact=None):
+        partition = cls(dim, config, exact)
+        partition.base = base
+        partition.base_alive = np.ones(len(base), dtype=bool)
+        partition.base_norms = np.einsum("ij,ij->i", base, base)
+        for slot, infrag in enumerate(infrags):
+            partition.infrags[slot] = infrag
+            partition.slots[id(infrag)] = slot
+            partition.keywords.add(infrag)
+        partition.next_slot = len(infrags)
+        partition.maintain()
+        return partition
+
+    def in_base(self, slot):
+        return self.base is not None and slot < len(self.base) and self.base_alive[slot]
+
+    def vector_count(self):
+        if self.quantized:
+            return self.index.ntotal
+        alive = int(self.base_alive.sum()) if self.base is not None else 0
+        return self.index.ntotal + alive
+
+    def __len__(self):
+        return len(self.infrags)
+
+    def add(self, infrag, vec):
+        self.add_many([infrag], [vec])
+
+    def add_many(self, infrags, vectors):
+        if not infrags:
+            return
+        slots = np.arange(self.next_slot, self.next_slot + len(infrags), dtype="int64")
+        self.next_slot += len(infrags)
+        vectors = np.array(vectors).astype("float32").reshape(-1, self.dim)
+        self.index.add_with_ids(vectors, slots)
+        if self.ann is not None:
+            self.ann.add_with_ids(vectors, slots)
+        for slot, infrag in zip(slots.tolist(), infrags):
+            self.infrags[slot] = infrag
+            self.slots[id(infrag)] = slot
+            self.keywords.add(infrag)
+        self.version = next(_versions)
+        self.maintain()
+
+    def remove(self, infrag):
+        slot = self.slots.pop(id(infrag), None)
+        if slot is None:
+            return False
+        in_base = self.in_base(slot)
+        if in_base:
+            self.base_alive[slot] = False
+        if self.quantized or not in_base:
+            self.index.remove_ids(np.array([slot], dtype="int64"))
+        del self.infrags[slot]
+        self.keywords.remove(infrag)
+        self.version = next(_versions)
+        self.maintain()
+        return True
+
+    def update(self, infrag, vec):
+        # a new slot, the approximate index may still hold the old one
+        self.remove(infrag)
+        self.add(infrag, vec)
+
+    def vectors(self, infrags):
+        return self.exact_vectors([self.slots[id(infrag)] for infrag in infrags])
+
+    # float32 vectors of slots, the quantized codes only when nothing else has them
+    def exact_vectors(self, slots):
+        vectors = [np.array(self.base[slot]) if self.in_base(slot) else None for slot in slots]
+        missing = [pos for pos, vec in enumerate(vectors) if vec is None]
+        if missing and self.quantized and self.exact is not None:
+            found = self.exact([self.infrags[slots[pos]] for pos in missing])
+            for pos, vec in zip(missing, found):
+                if vec is not None:
+                    vectors[pos] = np.asarray(vec, dtype="float32").reshape(self.dim)
+        return [self.index.reconstruct(slot) if vec is None else vec for slot, vec in zip(slots, vectors)]
+
+    # slots and vectors of the live fragments, base rows first
+    # (decoded from the codes once quantized)
+    def live_vectors(self):
+        slots = [np.empty(0, dtype="int64")]
+        vectors = [np.empty((0, self.dim), dtype="float32")]
+        if self.base is not None and not self.quantized:
+            alive = np.nonzero(self.base_alive)[0]
+            slots.append(alive.astype("int64"))
+            vectors.append(np.asarray(self.base[alive], dtype="float32"))
+        if self.index.ntotal:
+            slots.append(faiss.vector_to_array(self.index.id_map).astype("int64"))
+            vectors.append(self.index.index.reconstruct_n(0, self.index.ntotal))
+        return np.concatenate(slots), np.concatenate(vectors)
+
+    def build_ann(self):
+        slots, vectors = self.live_vectors()
+        self.ann = self.config.build(vectors, slots, self.dim)
+
+    def quantize(self):
+        slots, vectors = self.live_vectors()
+        self.index = self.config.storage(vectors, slots, self.dim)
+        self.quantized = True
+        # the base rows are only read back for re-ranking now
+        self.base_norms = None
+
+    # quantizes, promotes, rebuilds or drops the approximate index after a change
+    def maintain(self):
+        size = len(self.infrags)
+        if not self.quantized and self.config.quantizes(size):
+            self.quantize()
+        if self.ann is None:
+            if self.config.promotes(size):
+                self.build_ann()
+        elif not self.config.promotes(size * 2):
+            # well under the threshold, back to the exact search
+            self.ann = None
+        elif self.ann.ntotal - size > self.config.rebuild_ratio * self.ann.ntotal:
+            self.build_ann()
+
+    def set_config(self, config):
+        # other results, answers cached for this version are stale
+        self.version = next(_versions)
+        if config.same_structure(self.config):
+            if self.ann is not None:
+                config.tune(self.ann)
+            self.config = config
+            return
+        if self.quantized and config.quantizer != self.config.quantizer:
+            # back to float32, from the exact vectors
+            slots = sorted(self.infrags)
+            vectors = np.array(self.exact_vectors(slots), dtype="float32").reshape(-1, self.dim)
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+            self.quantized = False
+            if self.base is not None:
+                in_base = np.array([self.in_base(slot) for slot in slots], dtype=bool)
+                slots = np.array(slots, dtype="int64")[~in_base]
+                vectors = vectors[~in_base]
+                self.base_norms = np.einsum("ij,ij->i", self.base, self.base)
+            self.index.add_with_ids(vectors, np.array(slots, dtype="int64"))
+        self.config = config
+        self.ann = None
+        self.maintain()
+
+    # rough resident bytes, the mapped base is counted apart (page cache)
+    def memory(self):
+        storage = self.config if self.quantized else AnnConfig()
+        resident = self.index.ntotal * storage.vector_bytes(self.dim)
+        if self.ann is not None:
+            resident += self.ann.ntotal * self.config.vector_bytes(self.dim, ann=True)
+        mapped = self.base.nbytes if self.base is not None else 0
+        return {"vectors": len(self.infrags), "bytes": resident, "mapped_bytes": mapped}
+
+    def index_kind(self):
+        return self.config.kind if self.ann is not None else "flat"
+
+    def is_consistent(self):
+        return self.vector_count() == len(self.infrags) == len(self.slots)
+
+    def search_base(self, query, k):
+        # squared L2 distances to the live base rows, like IndexFlatL2
+        distances = self.base_norms - 2 * (self.base @ query) + query @ query
+        distances[~self.base_alive] = np.inf
+        k = min(k, len(distances))
+        top = np.argpartition(distances, k - 1)[:k]
+        return [(distances[slot], int(slot)) for slot in top if np.isfinite(distances[slot])]
+
+    def search_ann(self, query, k):
+        # stale slots take places in the results, ask for more until k are live
+        fetch = min(self.ann.ntotal, 2 * k)
+        while True:
+            D, I = self.ann.search(query.reshape(1, -1), fetch)
+            found = [int(slot) for slot in I[0] if slot >= 0 and slot in self.infrags]
+            if len(found) >= k or fetch >= self.ann.ntotal:
+                return found[:k]
+            fetch = min(self.ann.ntotal, 2 * fetch)
+
+    # exact distances of the candidates, the k closest
+    def rerank(self, query, slots, k):
+        if not slots:
+            return []
+        vectors = np.array(self.exact_vectors(slots), dtype="float32")
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        return [slots[pos] for pos in np.argsort(distances, kind="stable")[:k]]
+
+    def search(self, vec, k=10):
+        if not self.infrags:
+            return []
+        k = min(k, len(self.infrags))
+        query = np.asarray(vec, dtype="float32").reshape(self.dim)
+        if self.quantized:
+            fetch = min(len(self.infrags), k * max(1, self.config.rerank))
+            if self.ann is not None:
+                candidates = self.search_ann(query, fetch)
+            else:
+                D, I = self.index.search(query.reshape(1, -1), fetch)
+                candidates = [int(slot) for slot in I[0] if slot >= 0]
+            return [self.infrags[slot] for slot in self.rerank(query, candidates, k)]
+        if self.ann is not None:
+            return [self.infrags[slot] for slot in self.search_ann(query, k)]
+        if self.base is None:
+            D, I = self.index.search(query.reshape(1, -1), k)
+            return [self.infrags[slot] for slot in I[0] if slot >= 0]
+        found = self.search_base(query, k)
+        if self.index.ntotal:
+            D, I = self.index.search(query.reshape(1, -1), min(k, self.index.ntotal))
+            found += [(d, int(slot)) for d, slot in zip(D[0], I[0]) if slot >= 0]
+        found.sort()
+        return [self.infrags[slot] for _, slot in found[:k]]
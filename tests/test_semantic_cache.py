@@ -0,0 +1,30 @@
+import numpy as np
+from infrags_mgr.semantic_cache import SemanticCache
+
+def unit_vectors(count, dim=8):
+    return [np.eye(dim, dtype="float32")[i] for i in range(count)]
+
+def test_hit_on_a_later_entry_moves_it_last():
+    cache = SemanticCache(threshold=0.99)
+    vectors = unit_vectors(3)
+    for n, vec in enumerate(vectors):
+        cache.store("tenant", "scope", vec, 1, f"answer {n}")
+    assert cache.lookup("tenant", "scope", vectors[1], 1) == "answer 1"
+    entries = cache.tenants["tenant"]
+    assert [e[1] for e in entries] == ["answer 0", "answer 2", "answer 1"]
+    assert cache.lookup("tenant", "scope", vectors[0], 1) == "answer 0"
+    assert cache.stats()["hits"] == 2
+
+def test_other_version_or_scope_misses():
+    cache = SemanticCache(threshold=0.99)
+    vec = unit_vectors(1)[0]
+    cache.store("tenant", "scope", vec, 1, "answer")
+    assert cache.lookup("tenant", "other scope", vec, 1) is None
+    assert cache.lookup("tenant", "scope", vec, 2) is None
+
+def test_keyword_only_answers_are_keyed_by_their_terms():
+    cache = SemanticCache(threshold=0.99)
+    cache.store("tenant", "scope", None, 1, "answer", ["basile", "ne"])
+    assert cache.lookup("tenant", "scope", None, 1, ["ne", "basile"]) == "answer"
+    assert cache.lookup("tenant", "scope", None, 1, ["basile"]) is None
+    assert cache.lookup("tenant", "scope", unit_vectors(1)[0], 1) is None